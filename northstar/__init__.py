@@ -1,7 +1,7 @@
 import os
 import sys
 import time
-from typing import Union
+from typing import Dict, List, Tuple, Union
 
 import cv2
 import ntcore
@@ -9,15 +9,21 @@ import ntcore
 from calibration.CalibrationCommandSource import (CalibrationCommandSource,
                                                   NTCalibrationCommandSource)
 from calibration.CalibrationSession import CalibrationSession
+from config.calibration_profiles import select_calibration
 from config.config import ConfigStore, LocalConfig, RemoteConfig
 from config.ConfigSource import ConfigSource, FileConfigSource, NTConfigSource
 from output.OutputPublisher import NTOutputPublisher, OutputPublisher
-from output.overlay_util import *
-from output.StreamServer import MjpegServer
+from output.StreamServer import AsyncMjpegServer, MjpegServer, StreamServer
 from pipeline.CameraPoseEstimator import MultiTargetCameraPoseEstimator
-from pipeline.Capture import GStreamerCapture
-from pipeline.FiducialDetector import ArucoFiducialDetector
+from pipeline.Capture import Capture, FreshestFrameCapture, GStreamerCapture
+from pipeline.FiducialDetector import (AprilTagFiducialDetector,
+                                        ArucoFiducialDetector, FiducialDetector,
+                                        TagTracker)
+from pipeline.PipelineEngine import PipelineEngine, PipelineFrame
 from pipeline.PoseEstimator import SquareTargetPoseEstimator
+from pipeline.undistortion import undistort_observations
+from vision_types import (CameraPoseObservation, FiducialImageObservation,
+                          FiducialPoseObservation)
 
 DEMO_ID = 29
 
@@ -28,37 +34,78 @@ if __name__ == "__main__":
     remote_config_source: ConfigSource = NTConfigSource()
     calibration_command_source: CalibrationCommandSource = NTCalibrationCommandSource()
 
-    capture = GStreamerCapture()
-    fiducial_detector = ArucoFiducialDetector(cv2.aruco.DICT_APRILTAG_36h11)
-    camera_pose_estimator = MultiTargetCameraPoseEstimator()
-    tag_pose_estimator = SquareTargetPoseEstimator()
+    local_config_source.update(config)
+
+    capture: Capture = GStreamerCapture()
+    if config.local_config.capture_reader_thread:
+        capture = FreshestFrameCapture(capture)
     output_publisher: OutputPublisher = NTOutputPublisher()
-    stream_server = MjpegServer()
+    stream_server: StreamServer = MjpegServer()
+    if config.local_config.stream_server == "asyncio":
+        stream_server = AsyncMjpegServer()
     calibration_session = CalibrationSession()
 
-    local_config_source.update(config)
     ntcore.NetworkTableInstance.getDefault().setServer(config.local_config.server_ip)
     ntcore.NetworkTableInstance.getDefault().startClient4(config.local_config.device_id)
     stream_server.start(config)
+    if config.local_config.stream_passthrough:
+        # Serve the camera's own JPEG frames on the raw view, so nothing is re-encoded
+        capture.set_jpeg_listener(stream_server.set_jpeg)
+
+    # Tracked tags are shared by the workers, which each see only some of the frames
+    tag_tracker = TagTracker()
+
+    def make_frame_processor():
+        # Each worker thread gets its own detector and estimators
+        fiducial_detectors: Dict[str, FiducialDetector] = {}
+        camera_pose_estimator = MultiTargetCameraPoseEstimator()
+        tag_pose_estimator = SquareTargetPoseEstimator()
+
+        def process_frame(frame: PipelineFrame) -> Tuple[List[FiducialImageObservation], Union[CameraPoseObservation, None], Union[FiducialPoseObservation, None], List[FiducialPoseObservation]]:
+            # Backends are created on first use, so the AprilTag library is only needed if selected
+            backend = config.remote_config.detector_backend
+            if backend not in fiducial_detectors:
+                if backend == "apriltag":
+                    fiducial_detectors[backend] = AprilTagFiducialDetector("tag36h11", [DEMO_ID])
+                else:
+                    fiducial_detectors[backend] = ArucoFiducialDetector(cv2.aruco.DICT_APRILTAG_36h11, [DEMO_ID], tag_tracker)
+            image_observations = fiducial_detectors[backend].detect_fiducials(frame.image, config, frame.sequence)
+
+            # Corners are undistorted once for every solver, overlays still draw the detected ones
+            solver_observations = undistort_observations(image_observations, config)
+
+            # The frame budget runs from capture, so time spent queued for a worker counts against it
+            deadline = None
+            if config.remote_config.solver_frame_budget_ms > 0:
+                deadline = frame.timestamp + config.remote_config.solver_frame_budget_ms / 1000.0
+            camera_pose_observation = camera_pose_estimator.solve_camera_pose(
+                [x for x in solver_observations if x.tag_id != DEMO_ID], config, deadline)
+
+            # Per-tag poses for every visible tag, which include the demo tag's
+            tag_pose_observations: List[FiducialPoseObservation] = []
+            demo_pose_observation: Union[FiducialPoseObservation, None] = None
+            if config.remote_config.solver_per_tag_poses:
+                tag_pose_observations = tag_pose_estimator.solve_fiducial_poses(solver_observations, config)
+                demo_pose_observations = [x for x in tag_pose_observations if x.tag_id == DEMO_ID]
+                if len(demo_pose_observations) > 0:
+                    demo_pose_observation = demo_pose_observations[0]
+            else:
+                demo_image_observations = [x for x in solver_observations if x.tag_id == DEMO_ID]
+                if len(demo_image_observations) > 0:
+                    demo_pose_observation = tag_pose_estimator.solve_fiducial_pose(demo_image_observations[0], config)
+            return image_observations, camera_pose_observation, demo_pose_observation, tag_pose_observations
+
+        return process_frame
 
-    frame_count = 0
-    last_print = 0
     was_calibrating = False
-    while True:
+
+    def capture_frame() -> Union[Tuple[int, float, cv2.Mat], None]:
+        global was_calibrating
         remote_config_source.update(config)
-        timestamp = time.time()
-        success, image = capture.get_frame(config)
+        success, image, sequence, timestamp = capture.get_stamped_frame(config)
         if not success:
             time.sleep(0.5)
-            continue
-
-        fps = None
-        frame_count += 1
-        if time.time() - last_print > 1:
-            last_print = time.time()
-            fps = frame_count
-            print("Running at", frame_count, "fps")
-            frame_count = 0
+            return None
 
         if calibration_command_source.get_calibrating(config):
             # Calibration mode
@@ -70,22 +117,39 @@ if __name__ == "__main__":
             calibration_session.finish()
             sys.exit(0)
 
-        elif config.local_config.has_calibration:
-            # Normal mode
-            image_observations = fiducial_detector.detect_fiducials(image, config)
-            [overlay_image_observation(image, x) for x in image_observations]
-            camera_pose_observation = camera_pose_estimator.solve_camera_pose(
-                [x for x in image_observations if x.tag_id != DEMO_ID], config)
-            demo_image_observations = [x for x in image_observations if x.tag_id == DEMO_ID]
-            demo_pose_observation: Union[FiducialPoseObservation, None] = None
-            if len(demo_image_observations) > 0:
-                demo_pose_observation = tag_pose_estimator.solve_fiducial_pose(demo_image_observations[0], config)
-            output_publisher.send(config, timestamp, camera_pose_observation, demo_pose_observation, fps)
+        elif config.local_config.has_calibration and select_calibration(config, image.shape[1], image.shape[0]):
+            # Normal mode, hand off to the workers. The calibration follows the resolution of the frames.
+            return sequence, timestamp, image
 
         else:
             # No calibration
             print("No calibration found")
             time.sleep(0.5)
 
-        # image = cv2.undistort(image, config.local_config.camera_matrix, config.local_config.distortion_coefficients)
         stream_server.set_frame(image)
+        return None
+
+    frame_count = 0
+    last_print = 0
+
+    def publish_frame(frame: PipelineFrame) -> None:
+        global frame_count, last_print
+        fps = None
+        frame_count += 1
+        if time.time() - last_print > 1:
+            last_print = time.time()
+            fps = frame_count
+            print("Running at", frame_count, "fps")
+            frame_count = 0
+            dropped_count = capture.get_dropped_count() + engine.get_dropped_count()
+            if dropped_count > 0:
+                print("Dropped", dropped_count, "frames total")
+
+        image_observations, camera_pose_observation, demo_pose_observation, tag_pose_observations = frame.result
+        output_publisher.send(config, frame.timestamp, camera_pose_observation, demo_pose_observation, fps, tag_pose_observations)
+
+        # Overlays are drawn by the stream server, only when someone is watching
+        stream_server.set_frame(frame.image, image_observations)
+
+    engine = PipelineEngine(capture_frame, make_frame_processor, publish_frame, config.local_config.pipeline_workers)
+    engine.run()
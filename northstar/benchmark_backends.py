@@ -0,0 +1,59 @@
+import argparse
+import time
+
+import cv2
+import numpy
+
+from config.config import ConfigStore, LocalConfig, RemoteConfig
+from pipeline.FiducialDetector import AprilTagFiducialDetector, ArucoFiducialDetector
+from pipeline.recorded_frames import load_recorded_frames
+
+# Compares the ArUco and native AprilTag backends on recorded frames. Corner error is measured
+# against full resolution ArUco detections of the same tag, which serve as the reference.
+
+
+def run(fiducial_detector, images, config: ConfigStore):
+    detection_times = []
+    detections = []
+    for image in images:
+        start_time = time.perf_counter()
+        image_observations = fiducial_detector.detect_fiducials(image, config)
+        detection_times.append(time.perf_counter() - start_time)
+        detections.append({x.tag_id: x.corners for x in image_observations})
+    return float(numpy.mean(detection_times)), detections
+
+
+def corner_errors(detections, reference_detections) -> list:
+    errors = []
+    for frame_detections, frame_reference in zip(detections, reference_detections):
+        for tag_id, corners in frame_detections.items():
+            if tag_id in frame_reference:
+                errors.append(float(numpy.linalg.norm(corners - frame_reference[tag_id], axis=2).mean()))
+    return errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the ArUco and AprilTag detector backends")
+    parser.add_argument("frames", help="Directory of recorded frames")
+    parser.add_argument("--nthreads", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--quad-decimate", type=float, nargs="+", default=[1.0, 2.0])
+    args = parser.parse_args()
+
+    images = load_recorded_frames(args.frames)
+    config = ConfigStore(LocalConfig(), RemoteConfig())
+
+    reference_time, reference_detections = run(ArucoFiducialDetector(cv2.aruco.DICT_APRILTAG_36h11), images, config)
+    reference_tags = sum([len(x) for x in reference_detections])
+    print("ArUco (reference):", round(reference_time * 1000, 2), "ms/frame,", reference_tags, "tags")
+
+    fiducial_detector = AprilTagFiducialDetector("tag36h11")
+    for nthreads in args.nthreads:
+        for quad_decimate in args.quad_decimate:
+            config.remote_config.apriltag_nthreads = nthreads
+            config.remote_config.apriltag_quad_decimate = quad_decimate
+            detection_time, detections = run(fiducial_detector, images, config)
+            errors = corner_errors(detections, reference_detections)
+            print("AprilTag, " + str(nthreads) + " threads, decimate " + str(quad_decimate) + ":",
+                  round(detection_time * 1000, 2), "ms/frame (" + str(round(reference_time / detection_time, 1)) + "x),",
+                  sum([len(x) for x in detections]), "tags,",
+                  "mean corner error", round(float(numpy.mean(errors)), 2) if len(errors) > 0 else "n/a", "px")
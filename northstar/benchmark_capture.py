@@ -0,0 +1,56 @@
+import argparse
+import time
+
+import cv2
+
+from config.config import ConfigStore, LocalConfig, RemoteConfig
+from pipeline.Capture import GStreamerCapture
+
+PIXEL_FORMATS = ["MJPG", "YUYV"]
+WARMUP_FRAMES = 30
+
+# Reports the per-frame cost of each camera pixel format. CPU time covers every thread in the
+# process, so it includes GStreamer's decode and conversion work, not just the read call.
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark capture decode cost per pixel format")
+    parser.add_argument("--camera-id", type=int, default=RemoteConfig.camera_id)
+    parser.add_argument("--width", type=int, default=RemoteConfig.camera_resolution_width)
+    parser.add_argument("--height", type=int, default=RemoteConfig.camera_resolution_height)
+    parser.add_argument("--capture-format", default=LocalConfig.capture_format)
+    parser.add_argument("--frames", type=int, default=300)
+    args = parser.parse_args()
+
+    for pixel_format in PIXEL_FORMATS:
+        config = ConfigStore(LocalConfig(), RemoteConfig())
+        config.local_config.capture_format = args.capture_format
+        config.remote_config.camera_id = args.camera_id
+        config.remote_config.camera_resolution_width = args.width
+        config.remote_config.camera_resolution_height = args.height
+        config.remote_config.camera_pixel_format = pixel_format
+
+        video = cv2.VideoCapture(GStreamerCapture._get_pipeline(config), cv2.CAP_GSTREAMER)
+        if not video.isOpened():
+            print(pixel_format + ": failed to open pipeline (format not supported at this resolution?)")
+            continue
+
+        for _ in range(WARMUP_FRAMES):
+            video.read()
+
+        frame_count = 0
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        for _ in range(args.frames):
+            retval, _ = video.read()
+            if retval:
+                frame_count += 1
+        cpu_time = time.process_time() - cpu_start
+        wall_time = time.perf_counter() - wall_start
+        video.release()
+
+        if frame_count == 0:
+            print(pixel_format + ": no frames received")
+            continue
+        print(pixel_format + " @ " + str(args.width) + "x" + str(args.height) + " (" + args.capture_format + "):",
+              round(cpu_time / frame_count * 1000, 2), "ms CPU/frame,",
+              round(frame_count / wall_time, 1), "fps")
@@ -0,0 +1,80 @@
+import argparse
+import math
+import time
+
+import cv2
+import numpy
+from wpimath.geometry import *
+
+from config.config import ConfigStore, LocalConfig, RemoteConfig
+from config.ConfigSource import ConfigSource, FileConfigSource
+from pipeline.CameraPoseEstimator import MultiTargetCameraPoseEstimator
+from pipeline.FiducialDetector import ArucoFiducialDetector
+from pipeline.recorded_frames import load_recorded_frames
+
+DECIMATIONS = [1, 2, 3, 4]
+
+# Decimated detection must keep the multi-tag camera pose within these limits of the full
+# resolution result for every frame where both find a pose
+TRANSLATION_TOLERANCE_M = 0.02
+ROTATION_TOLERANCE_DEG = 1.0
+
+
+def rotation_difference_deg(rotation_a: Rotation3d, rotation_b: Rotation3d) -> float:
+    quaternion_a = rotation_a.getQuaternion()
+    quaternion_b = rotation_b.getQuaternion()
+    dot = abs(quaternion_a.W() * quaternion_b.W() + quaternion_a.X() * quaternion_b.X() +
+              quaternion_a.Y() * quaternion_b.Y() + quaternion_a.Z() * quaternion_b.Z())
+    return math.degrees(2 * math.acos(min(1.0, dot)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Validate decimated detection against full resolution poses")
+    parser.add_argument("frames", help="Directory of recorded frames from the calibrated camera")
+    parser.add_argument("--fiducial-size-m", type=float, default=RemoteConfig.fiducial_size_m)
+    args = parser.parse_args()
+
+    config = ConfigStore(LocalConfig(), RemoteConfig())
+    local_config_source: ConfigSource = FileConfigSource()
+    local_config_source.update(config)
+    config.remote_config.fiducial_size_m = args.fiducial_size_m
+    camera_pose_estimator = MultiTargetCameraPoseEstimator()
+
+    images = load_recorded_frames(args.frames)
+
+    reference_poses = []
+    reference_time = 0.0
+    for decimation in DECIMATIONS:
+        config.remote_config.detector_decimation = decimation
+        fiducial_detector = ArucoFiducialDetector(cv2.aruco.DICT_APRILTAG_36h11)
+        detection_times = []
+        tag_count = 0
+        translation_errors = []
+        rotation_errors = []
+        for i, image in enumerate(images):
+            start_time = time.perf_counter()
+            image_observations = fiducial_detector.detect_fiducials(image, config)
+            detection_times.append(time.perf_counter() - start_time)
+            tag_count += len(image_observations)
+            camera_pose_observation = camera_pose_estimator.solve_camera_pose(image_observations, config)
+            pose = None if camera_pose_observation == None else camera_pose_observation.pose_0
+
+            if decimation == 1:
+                reference_poses.append(pose)
+            elif pose != None and reference_poses[i] != None:
+                translation_errors.append(pose.translation().distance(reference_poses[i].translation()))
+                rotation_errors.append(rotation_difference_deg(pose.rotation(), reference_poses[i].rotation()))
+
+        detection_time = float(numpy.mean(detection_times))
+        if decimation == 1:
+            reference_time = detection_time
+            print("Decimation 1 (reference):", round(detection_time * 1000, 2), "ms/frame,", tag_count, "tags")
+            continue
+
+        max_translation_error = max(translation_errors, default=0.0)
+        max_rotation_error = max(rotation_errors, default=0.0)
+        passed = max_translation_error <= TRANSLATION_TOLERANCE_M and max_rotation_error <= ROTATION_TOLERANCE_DEG
+        print("Decimation " + str(decimation) + ":", round(detection_time * 1000, 2), "ms/frame (" +
+              str(round(reference_time / detection_time, 1)) + "x),", tag_count, "tags,",
+              "max pose error", round(max_translation_error * 100, 2), "cm /", round(max_rotation_error, 2), "deg,",
+              "PASS" if passed else "FAIL")
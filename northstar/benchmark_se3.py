@@ -0,0 +1,78 @@
+import argparse
+import time
+
+import numpy
+from wpimath.geometry import *
+
+from pipeline import se3
+from pipeline.coordinate_systems import openCvPoseToWpilib
+
+BATCH_SIZES = [1, 2, 4, 8, 16, 32, 64]
+
+# Compares the per-object wpimath path against the batched NumPy SE(3) module for the camera pose
+# chain used by the estimators: solvePnP output to WPILib axes, inverted and composed with a tag's
+# field pose. "Arrays" stops at 4x4 matrices, "Pose3d" includes creating the output objects.
+# "Scalar" is the per-object chain with se3.opencv_to_pose3d, which the estimators use for the one or
+# two poses of a frame.
+
+
+def run_objects(field_to_tag_pose: Pose3d, rvecs, tvecs):
+    poses = []
+    for rvec, tvec in zip(rvecs, tvecs):
+        camera_to_tag_pose = openCvPoseToWpilib(tvec, rvec)
+        camera_to_tag = Transform3d(camera_to_tag_pose.translation(), camera_to_tag_pose.rotation())
+        field_to_camera = field_to_tag_pose.transformBy(camera_to_tag.inverse())
+        poses.append(Pose3d(field_to_camera.translation(), field_to_camera.rotation()))
+    return poses
+
+
+def run_scalar(field_to_tag_pose: Pose3d, rvecs, tvecs):
+    poses = []
+    for rvec, tvec in zip(rvecs, tvecs):
+        camera_to_tag_pose = se3.opencv_to_pose3d(rvec, tvec)
+        camera_to_tag = Transform3d(camera_to_tag_pose.translation(), camera_to_tag_pose.rotation())
+        poses.append(field_to_tag_pose.transformBy(camera_to_tag.inverse()))
+    return poses
+
+
+def run_arrays(field_to_tag, rvecs, tvecs):
+    return se3.compose(field_to_tag, se3.invert(se3.opencv_to_wpilib(se3.from_opencv(rvecs, tvecs))))
+
+
+def time_per_pose(function, count: int, repeats: int) -> float:
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        function()
+    return (time.perf_counter() - start_time) / repeats / count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark batched SE(3) math against per-object wpimath")
+    parser.add_argument("--repeats", type=int, default=2000)
+    args = parser.parse_args()
+
+    rng = numpy.random.default_rng(0)
+    field_to_tag_pose = Pose3d(Translation3d(3.6576, 4.0259, 0.308102), Rotation3d(0.0, 0.0, numpy.pi))
+    field_to_tag = se3.from_pose3d(field_to_tag_pose)
+    for count in BATCH_SIZES:
+        rvecs = rng.normal(size=(count, 3, 1))
+        tvecs = rng.normal(size=(count, 3, 1)) + [[0.0], [0.0], [3.0]]
+
+        # Both paths must agree before their timings mean anything
+        object_poses = run_objects(field_to_tag_pose, rvecs, tvecs)
+        array_poses = se3.to_pose3ds(run_arrays(field_to_tag, rvecs, tvecs))
+        scalar_poses = run_scalar(field_to_tag_pose, rvecs, tvecs)
+        max_difference = max([numpy.abs(se3.from_pose3d(a) - se3.from_pose3d(b)).max() for a, b in zip(object_poses, array_poses)] +
+                             [numpy.abs(se3.from_pose3d(a) - se3.from_pose3d(b)).max() for a, b in zip(object_poses, scalar_poses)])
+        if max_difference > 1e-9:
+            print("Batch of " + str(count) + ": results differ by", max_difference)
+            continue
+
+        object_time = time_per_pose(lambda: run_objects(field_to_tag_pose, rvecs, tvecs), count, args.repeats)
+        scalar_time = time_per_pose(lambda: run_scalar(field_to_tag_pose, rvecs, tvecs), count, args.repeats)
+        array_time = time_per_pose(lambda: run_arrays(field_to_tag, rvecs, tvecs), count, args.repeats)
+        pose_time = time_per_pose(lambda: se3.to_pose3ds(run_arrays(field_to_tag, rvecs, tvecs)), count, args.repeats)
+        print("Batch of " + str(count) + ": objects", round(object_time * 1e6, 2), "us/pose, scalar",
+              round(scalar_time * 1e6, 2), "us/pose (" + str(round(object_time / scalar_time, 1)) + "x), arrays",
+              round(array_time * 1e6, 2), "us/pose (" + str(round(object_time / array_time, 1)) + "x), arrays + Pose3d",
+              round(pose_time * 1e6, 2), "us/pose (" + str(round(object_time / pose_time, 1)) + "x)")
@@ -0,0 +1,93 @@
+import argparse
+import time
+
+import cv2
+import numpy
+
+from config.config import ConfigStore, LocalConfig, RemoteConfig
+from pipeline import se3
+from pipeline.coordinate_systems import openCvPoseToWpilib
+from pipeline.PoseEstimator import SquareTargetPoseEstimator
+from vision_types import FiducialImageObservation
+
+TAG_COUNTS = [1, 2, 4, 8, 12, 16, 24, 32, 64]
+THREAD_COUNTS = [1, 2, 4]
+
+# Compares SquareTargetPoseEstimator.solve_fiducial_poses against solving each tag on its own with
+# OpenCV, as the demo tag path did before. Tags are synthetic projections through a nominal 1600x1200
+# camera. Both of the estimator's paths are timed at every tag count, to find BATCH_MIN_TAGS, and the
+# pool is timed at POOL_MIN_TAGS_PER_THREAD = 1 to find that threshold on the target.
+
+
+def make_observations(count: int, fid_size: float, camera_matrix, rng):
+    object_points = numpy.array([[-fid_size / 2.0, fid_size / 2.0, 0.0],
+                                 [fid_size / 2.0, fid_size / 2.0, 0.0],
+                                 [fid_size / 2.0, -fid_size / 2.0, 0.0],
+                                 [-fid_size / 2.0, -fid_size / 2.0, 0.0]])
+    observations = []
+    for tag_id in range(count):
+        rvec = numpy.array([numpy.pi, 0.0, 0.0]) + rng.normal(0.0, 0.3, 3)
+        tvec = numpy.array([rng.uniform(-1.0, 1.0), rng.uniform(-0.6, 0.6), rng.uniform(2.0, 5.0)])
+        corners, _ = cv2.projectPoints(object_points, rvec, tvec, camera_matrix, None)
+        observations.append(FiducialImageObservation(tag_id, corners.reshape(1, 4, 2).astype(numpy.float32)))
+    return object_points, observations
+
+
+def solve_individually(object_points, observations, config: ConfigStore):
+    poses = []
+    for observation in observations:
+        _, rvecs, tvecs, errors = cv2.solvePnPGeneric(object_points, observation.corners, config.local_config.camera_matrix,
+                                                      config.local_config.distortion_coefficients, flags=cv2.SOLVEPNP_IPPE_SQUARE)
+        poses.append((openCvPoseToWpilib(tvecs[0], rvecs[0]), errors[0][0], openCvPoseToWpilib(tvecs[1], rvecs[1]), errors[1][0]))
+    return poses
+
+
+def time_per_call(function, repeats: int) -> float:
+    """Best of several runs, since other processes on the coprocessor add noise."""
+    best_time = float("inf")
+    for _ in range(5):
+        start_time = time.perf_counter()
+        for _ in range(repeats):
+            function()
+        best_time = min(best_time, (time.perf_counter() - start_time) / repeats)
+    return best_time
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark batched per-tag pose solving")
+    parser.add_argument("--repeats", type=int, default=500)
+    args = parser.parse_args()
+
+    config = ConfigStore(LocalConfig(), RemoteConfig())
+    config.local_config.camera_matrix = numpy.array([[1000.0, 0.0, 800.0], [0.0, 1000.0, 600.0], [0.0, 0.0, 1.0]])
+    config.local_config.distortion_coefficients = numpy.array([[0.05, -0.1, 0.0, 0.0, 0.02]])
+    rng = numpy.random.default_rng(0)
+    pose_estimator = SquareTargetPoseEstimator()
+    pose_estimator.POOL_MIN_TAGS_PER_THREAD = 1
+
+    for count in TAG_COUNTS:
+        object_points, observations = make_observations(count, config.remote_config.fiducial_size_m, config.local_config.camera_matrix, rng)
+        # Both paths must agree before their timings mean anything
+        individual_time = time_per_call(lambda: solve_individually(object_points, observations, config), args.repeats)
+        results = [str(count) + " tags: individually " + str(round(individual_time * 1e6 / count, 1)) + " us/tag"]
+        config.remote_config.solver_tag_threads = 1
+        for name, batch_min_tags in [("per-tag", count + 1), ("batched", 1)]:
+            pose_estimator.BATCH_MIN_TAGS = batch_min_tags
+            max_difference = 0.0
+            for individual, solved in zip(solve_individually(object_points, observations, config), pose_estimator.solve_fiducial_poses(observations, config)):
+                max_difference = max(max_difference, numpy.abs(se3.from_pose3d(individual[0]) - se3.from_pose3d(solved.pose_0)).max(),
+                                     abs(individual[1] - solved.error_0))
+            if max_difference > 1e-4:
+                results.append(name + " results differ by " + str(max_difference))
+                continue
+            solve_time = time_per_call(lambda: pose_estimator.solve_fiducial_poses(observations, config), args.repeats)
+            results.append(name + " " + str(round(solve_time * 1e6 / count, 1)) + " us/tag (" + str(round(individual_time / solve_time, 1)) + "x)")
+
+        # The pool with the estimator's own choice of path in each thread
+        pose_estimator.BATCH_MIN_TAGS = SquareTargetPoseEstimator.BATCH_MIN_TAGS
+        for threads in THREAD_COUNTS[1:]:
+            config.remote_config.solver_tag_threads = threads
+            solve_time = time_per_call(lambda: pose_estimator.solve_fiducial_poses(observations, config), args.repeats)
+            results.append(str(threads) + " threads " + str(round(solve_time * 1e6 / count, 1)) + " us/tag (" +
+                           str(round(individual_time / solve_time, 1)) + "x)")
+        print(", ".join(results))
@@ -0,0 +1,57 @@
+import argparse
+import os
+import time
+
+import cv2
+import numpy
+
+from config.config import ConfigStore, LocalConfig, RemoteConfig
+from pipeline.FiducialDetector import ArucoFiducialDetector
+from pipeline.recorded_frames import load_recorded_frames
+
+# Tile layouts to compare for each core count
+TILE_LAYOUTS = {4: (2, 2), 8: (2, 4)}
+
+# Compares tiled detection against a single detectMarkers call with the process pinned to 4 and 8
+# cores. Core counts the machine does not have are skipped.
+
+
+def run(images, config: ConfigStore, repeats: int):
+    fiducial_detector = ArucoFiducialDetector(cv2.aruco.DICT_APRILTAG_36h11)
+    tag_count = 0
+    detection_times = []
+    for _ in range(repeats):
+        for image in images:
+            start_time = time.perf_counter()
+            tag_count += len(fiducial_detector.detect_fiducials(image, config))
+            detection_times.append(time.perf_counter() - start_time)
+    return float(numpy.mean(detection_times)), tag_count // repeats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark tiled parallel detection")
+    parser.add_argument("frames", help="Directory of recorded frames")
+    parser.add_argument("--overlap", type=int, default=RemoteConfig.detector_tile_overlap)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    images = load_recorded_frames(args.frames)
+    available_cores = sorted(os.sched_getaffinity(0))
+
+    for cores, (rows, cols) in TILE_LAYOUTS.items():
+        if len(available_cores) < cores:
+            print(str(cores) + " cores: skipped, only", len(available_cores), "available")
+            continue
+        os.sched_setaffinity(0, available_cores[:cores])
+        cv2.setNumThreads(cores)
+
+        config = ConfigStore(LocalConfig(), RemoteConfig())
+        single_time, single_tags = run(images, config, args.repeats)
+        config.remote_config.detector_tile_rows = rows
+        config.remote_config.detector_tile_cols = cols
+        config.remote_config.detector_tile_overlap = args.overlap
+        tiled_time, tiled_tags = run(images, config, args.repeats)
+        print(str(cores) + " cores: single call", round(single_time * 1000, 2), "ms (" + str(single_tags) + " tags),",
+              str(rows) + "x" + str(cols), "tiles", round(tiled_time * 1000, 2), "ms (" + str(tiled_tags) + " tags),",
+              str(round(single_time / tiled_time, 2)) + "x speedup")
+        os.sched_setaffinity(0, available_cores)
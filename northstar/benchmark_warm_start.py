@@ -0,0 +1,107 @@
+import argparse
+import math
+import time
+
+import cv2
+import numpy
+from wpimath.geometry import *
+
+from config.config import ConfigStore, LocalConfig, RemoteConfig
+from pipeline import se3
+from pipeline.CameraPoseEstimator import MultiTargetCameraPoseEstimator
+from pipeline.tag_layout import get_tag_layout, get_tag_layout_index
+from vision_types import FiducialImageObservation
+
+CORNER_NOISE_PX = [0.1, 0.3, 1.0]
+CAMERA_SPEEDS_M_PER_FRAME = [0.0, 0.01]  # Standing still, and 0.5 m/s at 50 fps
+
+# Compares multi-tag camera pose jitter with and without solver_warm_start over steady tracking.
+# Frames are synthetic projections of the layout's tags through a nominal 1600x1200 camera, which
+# looks at the tags from in front of them and moves sideways at a constant speed, with Gaussian
+# noise on every corner. Jitter is the standard deviation of the pose error against the true pose,
+# so it leaves out any constant bias.
+
+
+def look_at(camera_position, target, down):
+    """OpenCV rotation and translation vectors of a camera at "camera_position" facing "target"."""
+    z_axis = (target - camera_position) / numpy.linalg.norm(target - camera_position)
+    x_axis = numpy.cross(down, z_axis)
+    x_axis /= numpy.linalg.norm(x_axis)
+    camera_to_world = numpy.stack([x_axis, numpy.cross(z_axis, x_axis), z_axis], axis=1)
+    rvec, _ = cv2.Rodrigues(camera_to_world.T)
+    return rvec, -camera_to_world.T @ camera_position
+
+
+def opencv_to_field_pose(rvec, tvec) -> Pose3d:
+    """Field to camera pose from a solvePnP solution, as the estimator computes it."""
+    camera_to_field_pose = se3.opencv_to_pose3d(rvec, tvec)
+    field_to_camera = Transform3d(camera_to_field_pose.translation(), camera_to_field_pose.rotation()).inverse()
+    return Pose3d(field_to_camera.translation(), field_to_camera.rotation())
+
+
+def make_frames(tag_ids, config: ConfigStore, frame_count: int, speed: float, noise: float, rng):
+    layout_index = get_tag_layout_index(get_tag_layout(config), config.remote_config.fiducial_size_m)
+    object_points = layout_index.get_object_points(tag_ids)
+    target = object_points.mean(axis=0)
+
+    # Tags face out along their +x axis, converted here to OpenCV field axes like the object points
+    normals = [se3.WPILIB_TO_OPENCV[:3, :3] @ numpy.array([x.X(), x.Y(), x.Z()]) for x in
+               [Translation3d(1.0, 0.0, 0.0).rotateBy(layout_index.tag_poses[tag_id].rotation()) for tag_id in tag_ids]]
+    normal = numpy.mean(normals, axis=0)
+    normal /= numpy.linalg.norm(normal)
+    down = se3.WPILIB_TO_OPENCV[:3, :3] @ numpy.array([0.0, 0.0, -1.0])
+    sideways = numpy.cross(down, normal)
+
+    frames = []
+    for i in range(frame_count):
+        camera_position = target + 3.0 * normal + (i - frame_count / 2) * speed * sideways
+        rvec, tvec = look_at(camera_position, target + (i - frame_count / 2) * speed * sideways * 0.5, down)
+        corners, _ = cv2.projectPoints(object_points, rvec, tvec, config.local_config.camera_matrix, config.local_config.distortion_coefficients)
+        corners = corners.reshape(-1, 4, 2) + rng.normal(0.0, noise, (len(tag_ids), 4, 2))
+        frames.append(([FiducialImageObservation(tag_id, x.reshape(1, 4, 2).astype(numpy.float32)) for tag_id, x in zip(tag_ids, corners)],
+                       opencv_to_field_pose(rvec, tvec)))
+    return frames
+
+
+def run(frames, config: ConfigStore):
+    """Translation jitter (m), rotation jitter (deg), median solve time (s) and the frames refined from the previous one."""
+    pose_estimator = MultiTargetCameraPoseEstimator()
+    refinements = []
+    refine = pose_estimator._refine_previous_solution
+    pose_estimator._refine_previous_solution = lambda *args: refinements.append(refine(*args)) or refinements[-1]
+
+    errors = []
+    solve_times = []
+    for observations, true_pose in frames:
+        start_time = time.perf_counter()
+        observation = pose_estimator.solve_camera_pose(observations, config)
+        solve_times.append(time.perf_counter() - start_time)
+        error = observation.pose_0.relativeTo(true_pose)
+        errors.append([error.X(), error.Y(), error.Z(), error.rotation().X(), error.rotation().Y(), error.rotation().Z()])
+    deviations = numpy.std(numpy.array(errors), axis=0)
+    return (math.sqrt(numpy.sum(deviations[:3] ** 2)), math.degrees(math.sqrt(numpy.sum(deviations[3:] ** 2))),
+            float(numpy.median(solve_times)), len([x for x in refinements if x != None]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark multi-tag pose jitter with and without the warm start")
+    parser.add_argument("--tags", default="17,18,19", help="Comma separated IDs of the visible tags")
+    parser.add_argument("--frames", type=int, default=500)
+    args = parser.parse_args()
+
+    config = ConfigStore(LocalConfig(), RemoteConfig())
+    config.local_config.camera_matrix = numpy.array([[1000.0, 0.0, 800.0], [0.0, 1000.0, 600.0], [0.0, 0.0, 1.0]])
+    config.local_config.distortion_coefficients = numpy.array([[0.05, -0.1, 0.0, 0.0, 0.02]])
+    tag_ids = [int(x) for x in args.tags.split(",")]
+
+    for speed in CAMERA_SPEEDS_M_PER_FRAME:
+        for noise in CORNER_NOISE_PX:
+            frames = make_frames(tag_ids, config, args.frames, speed, noise, numpy.random.default_rng(0))
+            results = []
+            for warm_start in [False, True]:
+                config.remote_config.solver_warm_start = warm_start
+                translation_jitter, rotation_jitter, solve_time, refined_frames = run(frames, config)
+                results.append(("warm start" if warm_start else "SQPNP") + " " + str(round(translation_jitter * 1000, 2)) + " mm, " +
+                               str(round(rotation_jitter, 3)) + " deg, " + str(round(solve_time * 1e6)) + " us" +
+                               (" (" + str(refined_frames) + "/" + str(len(frames)) + " refined)" if warm_start else ""))
+            print(str(speed) + " m/frame, " + str(noise) + " px noise: " + ", ".join(results))
@@ -53,12 +53,16 @@ class CalibrationSession:
             self._all_charuco_corners, self._all_charuco_ids, self._charuco_board, self._imsize, None, None)
 
         if retval:
-            calibration_store = cv2.FileStorage(FileConfigSource.CALIBRATION_FILENAME, cv2.FILE_STORAGE_WRITE)
-            calibration_store.write("calibration_date", str(datetime.datetime.now()))
-            calibration_store.write("camera_resolution", self._imsize)
-            calibration_store.write("camera_matrix", camera_matrix)
-            calibration_store.write("distortion_coefficients", distortion_coefficients)
-            calibration_store.release()
+            # Also kept as the native calibration for this resolution, for when the camera is switched between resolutions
+            profile_filename = FileConfigSource.CALIBRATION_PROFILE_PATTERN.replace(
+                "*x*", str(self._imsize[1]) + "x" + str(self._imsize[0]))
+            for filename in [FileConfigSource.CALIBRATION_FILENAME, profile_filename]:
+                calibration_store = cv2.FileStorage(filename, cv2.FILE_STORAGE_WRITE)
+                calibration_store.write("calibration_date", str(datetime.datetime.now()))
+                calibration_store.write("camera_resolution", self._imsize)
+                calibration_store.write("camera_matrix", camera_matrix)
+                calibration_store.write("distortion_coefficients", distortion_coefficients)
+                calibration_store.release()
             print("Calibration finished")
         else:
             print("ERROR: Calibration failed")
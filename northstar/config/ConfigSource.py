@@ -1,10 +1,15 @@
+import dataclasses
+import glob
 import json
+import os
+from typing import Union
 
 import cv2
 import ntcore
 import numpy
 
-from config.config import ConfigStore, RemoteConfig
+from config.config import ConfigStore, LocalConfig, RemoteConfig
+from pipeline.tag_layout import parse_pushed_tag_layout
 
 
 class ConfigSource:
@@ -15,6 +20,7 @@ class ConfigSource:
 class FileConfigSource(ConfigSource):
     CONFIG_FILENAME = "config.json"
     CALIBRATION_FILENAME = "calibration.json"
+    CALIBRATION_PROFILE_PATTERN = "calibration_*x*.json"  # calibration_<width>x<height>.json
 
     def __init__(self) -> None:
         pass
@@ -26,16 +32,39 @@ class FileConfigSource(ConfigSource):
             config_store.local_config.device_id = config_data["device_id"]
             config_store.local_config.server_ip = config_data["server_ip"]
             config_store.local_config.stream_port = config_data["stream_port"]
+            config_store.local_config.pipeline_workers = config_data.get("pipeline_workers", LocalConfig.pipeline_workers)
+            config_store.local_config.capture_reader_thread = config_data.get(
+                "capture_reader_thread", LocalConfig.capture_reader_thread)
+            config_store.local_config.capture_format = config_data.get("capture_format", LocalConfig.capture_format)
+            config_store.local_config.stream_passthrough = config_data.get(
+                "stream_passthrough", LocalConfig.stream_passthrough)
+            config_store.local_config.stream_max_fps = config_data.get("stream_max_fps", LocalConfig.stream_max_fps)
+            config_store.local_config.stream_quality = config_data.get("stream_quality", LocalConfig.stream_quality)
+            config_store.local_config.stream_scale = config_data.get("stream_scale", LocalConfig.stream_scale)
+            config_store.local_config.stream_server = config_data.get("stream_server", LocalConfig.stream_server)
+            config_store.local_config.stream_max_clients = config_data.get(
+                "stream_max_clients", LocalConfig.stream_max_clients)
 
-        # Get calibration
-        calibration_store = cv2.FileStorage(self.CALIBRATION_FILENAME, cv2.FILE_STORAGE_READ)
-        camera_matrix = calibration_store.getNode("camera_matrix").mat()
-        distortion_coefficients = calibration_store.getNode("distortion_coefficients").mat()
-        calibration_store.release()
-        if type(camera_matrix) == numpy.ndarray and type(distortion_coefficients) == numpy.ndarray:
-            config_store.local_config.camera_matrix = camera_matrix
-            config_store.local_config.distortion_coefficients = distortion_coefficients
-            config_store.local_config.has_calibration = True
+        # Get calibrations, native calibrations kept for each resolution and then the latest one
+        for filename in sorted(glob.glob(self.CALIBRATION_PROFILE_PATTERN)) + [self.CALIBRATION_FILENAME]:
+            if not os.path.exists(filename):
+                continue
+            calibration_store = cv2.FileStorage(filename, cv2.FILE_STORAGE_READ)
+            camera_matrix = calibration_store.getNode("camera_matrix").mat()
+            distortion_coefficients = calibration_store.getNode("distortion_coefficients").mat()
+            camera_resolution = calibration_store.getNode("camera_resolution").mat()
+            calibration_store.release()
+            if type(camera_matrix) == numpy.ndarray and type(distortion_coefficients) == numpy.ndarray:
+                # Stored as (rows, cols)
+                resolution = (0, 0)
+                if type(camera_resolution) == numpy.ndarray:
+                    resolution = (int(camera_resolution.flatten()[1]), int(camera_resolution.flatten()[0]))
+                config_store.local_config.calibration_profiles[resolution] = (camera_matrix, distortion_coefficients)
+                if filename == self.CALIBRATION_FILENAME:
+                    config_store.local_config.camera_matrix = camera_matrix
+                    config_store.local_config.distortion_coefficients = distortion_coefficients
+                    config_store.local_config.calibration_resolution = resolution
+                config_store.local_config.has_calibration = True
 
 
 class NTConfigSource(ConfigSource):
@@ -43,11 +72,32 @@ class NTConfigSource(ConfigSource):
     _camera_id_sub: ntcore.IntegerSubscriber
     _camera_resolution_width_sub: ntcore.IntegerSubscriber
     _camera_resolution_height_sub: ntcore.IntegerSubscriber
+    _camera_pixel_format_sub: ntcore.StringSubscriber
     _camera_auto_exposure_sub: ntcore.IntegerSubscriber
     _camera_exposure_sub: ntcore.IntegerSubscriber
     _camera_gain_sub: ntcore.IntegerSubscriber
     _fiducial_size_m_sub: ntcore.DoubleSubscriber
+    _detector_backend_sub: ntcore.StringSubscriber
+    _detector_roi_tracking_sub: ntcore.BooleanSubscriber
+    _detector_full_scan_interval_sub: ntcore.IntegerSubscriber
+    _detector_decimation_sub: ntcore.IntegerSubscriber
+    _detector_tile_rows_sub: ntcore.IntegerSubscriber
+    _detector_tile_cols_sub: ntcore.IntegerSubscriber
+    _detector_tile_overlap_sub: ntcore.IntegerSubscriber
+    _detector_adaptive_params_sub: ntcore.BooleanSubscriber
+    _detector_wide_sweep_interval_sub: ntcore.IntegerSubscriber
+    _solver_warm_start_sub: ntcore.BooleanSubscriber
+    _solver_frame_budget_ms_sub: ntcore.DoubleSubscriber
+    _solver_cheap_max_tags_sub: ntcore.IntegerSubscriber
+    _solver_per_tag_poses_sub: ntcore.BooleanSubscriber
+    _solver_tag_threads_sub: ntcore.IntegerSubscriber
+    _apriltag_nthreads_sub: ntcore.IntegerSubscriber
+    _apriltag_quad_decimate_sub: ntcore.DoubleSubscriber
+    _apriltag_quad_sigma_sub: ntcore.DoubleSubscriber
+    _apriltag_refine_edges_sub: ntcore.BooleanSubscriber
     _tag_layout_sub: ntcore.DoubleSubscriber
+    _tag_layout_json: Union[str, None] = None
+    _change_poller: ntcore.NetworkTableListenerPoller
 
     def update(self, config_store: ConfigStore) -> None:
         # Initialize subscribers on first call
@@ -59,6 +109,8 @@ class NTConfigSource(ConfigSource):
                 "camera_resolution_width").subscribe(RemoteConfig.camera_resolution_width)
             self._camera_resolution_height_sub = nt_table.getIntegerTopic(
                 "camera_resolution_height").subscribe(RemoteConfig.camera_resolution_height)
+            self._camera_pixel_format_sub = nt_table.getStringTopic(
+                "camera_pixel_format").subscribe(RemoteConfig.camera_pixel_format)
             self._camera_auto_exposure_sub = nt_table.getIntegerTopic(
                 "camera_auto_exposure").subscribe(RemoteConfig.camera_auto_exposure)
             self._camera_exposure_sub = nt_table.getIntegerTopic(
@@ -67,20 +119,88 @@ class NTConfigSource(ConfigSource):
                 "camera_gain").subscribe(RemoteConfig.camera_gain)
             self._fiducial_size_m_sub = nt_table.getDoubleTopic(
                 "fiducial_size_m").subscribe(RemoteConfig.fiducial_size_m)
+            self._detector_backend_sub = nt_table.getStringTopic(
+                "detector_backend").subscribe(RemoteConfig.detector_backend)
+            self._detector_roi_tracking_sub = nt_table.getBooleanTopic(
+                "detector_roi_tracking").subscribe(RemoteConfig.detector_roi_tracking)
+            self._detector_full_scan_interval_sub = nt_table.getIntegerTopic(
+                "detector_full_scan_interval").subscribe(RemoteConfig.detector_full_scan_interval)
+            self._detector_decimation_sub = nt_table.getIntegerTopic(
+                "detector_decimation").subscribe(RemoteConfig.detector_decimation)
+            self._detector_tile_rows_sub = nt_table.getIntegerTopic(
+                "detector_tile_rows").subscribe(RemoteConfig.detector_tile_rows)
+            self._detector_tile_cols_sub = nt_table.getIntegerTopic(
+                "detector_tile_cols").subscribe(RemoteConfig.detector_tile_cols)
+            self._detector_tile_overlap_sub = nt_table.getIntegerTopic(
+                "detector_tile_overlap").subscribe(RemoteConfig.detector_tile_overlap)
+            self._detector_adaptive_params_sub = nt_table.getBooleanTopic(
+                "detector_adaptive_params").subscribe(RemoteConfig.detector_adaptive_params)
+            self._detector_wide_sweep_interval_sub = nt_table.getIntegerTopic(
+                "detector_wide_sweep_interval").subscribe(RemoteConfig.detector_wide_sweep_interval)
+            self._solver_warm_start_sub = nt_table.getBooleanTopic(
+                "solver_warm_start").subscribe(RemoteConfig.solver_warm_start)
+            self._solver_frame_budget_ms_sub = nt_table.getDoubleTopic(
+                "solver_frame_budget_ms").subscribe(RemoteConfig.solver_frame_budget_ms)
+            self._solver_cheap_max_tags_sub = nt_table.getIntegerTopic(
+                "solver_cheap_max_tags").subscribe(RemoteConfig.solver_cheap_max_tags)
+            self._solver_per_tag_poses_sub = nt_table.getBooleanTopic(
+                "solver_per_tag_poses").subscribe(RemoteConfig.solver_per_tag_poses)
+            self._solver_tag_threads_sub = nt_table.getIntegerTopic(
+                "solver_tag_threads").subscribe(RemoteConfig.solver_tag_threads)
+            self._apriltag_nthreads_sub = nt_table.getIntegerTopic(
+                "apriltag_nthreads").subscribe(RemoteConfig.apriltag_nthreads)
+            self._apriltag_quad_decimate_sub = nt_table.getDoubleTopic(
+                "apriltag_quad_decimate").subscribe(RemoteConfig.apriltag_quad_decimate)
+            self._apriltag_quad_sigma_sub = nt_table.getDoubleTopic(
+                "apriltag_quad_sigma").subscribe(RemoteConfig.apriltag_quad_sigma)
+            self._apriltag_refine_edges_sub = nt_table.getBooleanTopic(
+                "apriltag_refine_edges").subscribe(RemoteConfig.apriltag_refine_edges)
             self._tag_layout_sub = nt_table.getStringTopic(
                 "tag_layout").subscribe("")
+
+            # Changes are queued by NT and polled here, rather than read from every subscriber each frame
+            self._change_poller = ntcore.NetworkTableListenerPoller(ntcore.NetworkTableInstance.getDefault())
+            self._change_poller.addListener(["/" + config_store.local_config.device_id + "/config/"], ntcore.EventFlags.kValueAll)
             self._init_complete = True
+        elif len(self._change_poller.readQueue()) == 0:
+            return
+
+        # Read config data into a new snapshot
+        remote_config = dataclasses.replace(config_store.remote_config)
+        remote_config.camera_id = self._camera_id_sub.get()
+        remote_config.camera_resolution_width = self._camera_resolution_width_sub.get()
+        remote_config.camera_resolution_height = self._camera_resolution_height_sub.get()
+        remote_config.camera_pixel_format = self._camera_pixel_format_sub.get()
+        remote_config.camera_auto_exposure = self._camera_auto_exposure_sub.get()
+        remote_config.camera_exposure = self._camera_exposure_sub.get()
+        remote_config.camera_gain = self._camera_gain_sub.get()
+        remote_config.fiducial_size_m = self._fiducial_size_m_sub.get()
+        remote_config.detector_backend = self._detector_backend_sub.get()
+        remote_config.detector_roi_tracking = self._detector_roi_tracking_sub.get()
+        remote_config.detector_full_scan_interval = self._detector_full_scan_interval_sub.get()
+        remote_config.detector_decimation = self._detector_decimation_sub.get()
+        remote_config.detector_tile_rows = self._detector_tile_rows_sub.get()
+        remote_config.detector_tile_cols = self._detector_tile_cols_sub.get()
+        remote_config.detector_tile_overlap = self._detector_tile_overlap_sub.get()
+        remote_config.detector_adaptive_params = self._detector_adaptive_params_sub.get()
+        remote_config.detector_wide_sweep_interval = self._detector_wide_sweep_interval_sub.get()
+        remote_config.solver_warm_start = self._solver_warm_start_sub.get()
+        remote_config.solver_frame_budget_ms = self._solver_frame_budget_ms_sub.get()
+        remote_config.solver_cheap_max_tags = self._solver_cheap_max_tags_sub.get()
+        remote_config.solver_per_tag_poses = self._solver_per_tag_poses_sub.get()
+        remote_config.solver_tag_threads = self._solver_tag_threads_sub.get()
+        remote_config.apriltag_nthreads = self._apriltag_nthreads_sub.get()
+        remote_config.apriltag_quad_decimate = self._apriltag_quad_decimate_sub.get()
+        remote_config.apriltag_quad_sigma = self._apriltag_quad_sigma_sub.get()
+        remote_config.apriltag_refine_edges = self._apriltag_refine_edges_sub.get()
 
-        # Read config data
-        config_store.remote_config.camera_id = self._camera_id_sub.get()
-        config_store.remote_config.camera_resolution_width = self._camera_resolution_width_sub.get()
-        config_store.remote_config.camera_resolution_height = self._camera_resolution_height_sub.get()
-        config_store.remote_config.camera_auto_exposure = self._camera_auto_exposure_sub.get()
-        config_store.remote_config.camera_exposure = self._camera_exposure_sub.get()
-        config_store.remote_config.camera_gain = self._camera_gain_sub.get()
-        config_store.remote_config.fiducial_size_m = self._fiducial_size_m_sub.get()
-        try:
-            config_store.remote_config.tag_layout = json.loads(self._tag_layout_sub.get())
-        except:
-            config_store.remote_config.tag_layout = None
-            pass
+        # The layout is only parsed when its JSON changes, and only once for each distinct layout
+        tag_layout_json = self._tag_layout_sub.get()
+        if tag_layout_json != self._tag_layout_json:
+            self._tag_layout_json = tag_layout_json
+            remote_config.tag_layout = None
+            if tag_layout_json != "":
+                remote_config.tag_layout = parse_pushed_tag_layout(tag_layout_json, remote_config.fiducial_size_m)
+                if remote_config.tag_layout == None:
+                    print("Ignoring invalid pushed tag layout")
+        config_store.publish_remote_config(remote_config)
@@ -0,0 +1,64 @@
+from typing import Tuple, Union
+
+import numpy
+import numpy.typing
+
+from config.config import ConfigStore
+
+ASPECT_RATIO_TOLERANCE = 0.01  # Relative difference in aspect ratio still treated as the same
+
+
+def scale_camera_matrix(camera_matrix: numpy.typing.NDArray[numpy.float64], from_resolution: Tuple[int, int],
+                        to_resolution: Tuple[int, int]) -> numpy.typing.NDArray[numpy.float64]:
+    """Scale intrinsics to another resolution of the same sensor area. Distortion coefficients are unchanged."""
+    scale_x = to_resolution[0] / from_resolution[0]
+    scale_y = to_resolution[1] / from_resolution[1]
+    scaled_matrix = numpy.array(camera_matrix, dtype=numpy.float64)
+    scaled_matrix[0, 0] *= scale_x
+    scaled_matrix[1, 1] *= scale_y
+    scaled_matrix[0, 1] *= scale_x
+    # Pixel centers are at integer coordinates, so the principal point scales about (-0.5, -0.5)
+    scaled_matrix[0, 2] = (scaled_matrix[0, 2] + 0.5) * scale_x - 0.5
+    scaled_matrix[1, 2] = (scaled_matrix[1, 2] + 0.5) * scale_y - 0.5
+    return scaled_matrix
+
+
+def select_calibration(config_store: ConfigStore, width: int, height: int) -> bool:
+    """Make the calibration for a resolution active, returning whether there is one.
+
+    A native calibration is used if there is one, otherwise the largest calibration with the same
+    aspect ratio is scaled to fit. A calibration saved without its resolution is used as is.
+    """
+    local_config = config_store.local_config
+    resolution = (width, height)
+    if local_config.calibration_resolution == resolution:
+        return local_config.camera_matrix.size > 0
+
+    source_resolution: Union[Tuple[int, int], None] = None
+    if resolution in local_config.calibration_profiles:
+        source_resolution = resolution
+    else:
+        matching_resolutions = [x for x in local_config.calibration_profiles.keys() if x != (0, 0) and
+                                abs(x[0] * height - x[1] * width) <= ASPECT_RATIO_TOLERANCE * x[1] * width]
+        if len(matching_resolutions) > 0:
+            source_resolution = max(matching_resolutions)
+        elif (0, 0) in local_config.calibration_profiles:
+            source_resolution = (0, 0)
+
+    # New arrays are assigned rather than updated in place, so caches keyed on them are rebuilt
+    local_config.calibration_resolution = resolution
+    if source_resolution == None:
+        print("No calibration for " + str(width) + "x" + str(height))
+        local_config.camera_matrix = numpy.array([])
+        local_config.distortion_coefficients = numpy.array([])
+        return False
+    camera_matrix, distortion_coefficients = local_config.calibration_profiles[source_resolution]
+    if source_resolution in [resolution, (0, 0)]:
+        local_config.camera_matrix = camera_matrix
+        print("Using calibration for " + str(width) + "x" + str(height))
+    else:
+        local_config.camera_matrix = scale_camera_matrix(camera_matrix, source_resolution, resolution)
+        print("Using calibration for " + str(width) + "x" + str(height) + ", scaled from " +
+              str(source_resolution[0]) + "x" + str(source_resolution[1]))
+    local_config.distortion_coefficients = distortion_coefficients
+    return True
@@ -1,4 +1,6 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from typing import Dict, Tuple
+
 import numpy
 import numpy.typing
 
@@ -11,6 +13,19 @@ class LocalConfig:
     has_calibration: bool = True
     camera_matrix: numpy.typing.NDArray[numpy.float64] = numpy.array([])
     distortion_coefficients: numpy.typing.NDArray[numpy.float64] = numpy.array([])
+    calibration_resolution: Tuple[int, int] = (0, 0)  # (width, height) of the active calibration
+    # (width, height) to (camera matrix, distortion coefficients), (0, 0) for a calibration without a resolution
+    calibration_profiles: Dict[Tuple[int, int], Tuple[numpy.typing.NDArray[numpy.float64],
+                                                      numpy.typing.NDArray[numpy.float64]]] = field(default_factory=dict)
+    pipeline_workers: int = 3
+    capture_reader_thread: bool = False
+    capture_format: str = "BGR"  # "BGR" or "GRAY8"
+    stream_passthrough: bool = False
+    stream_max_fps: float = 30.0
+    stream_quality: int = 75
+    stream_scale: float = 1.0
+    stream_server: str = "threaded"  # "threaded" or "asyncio"
+    stream_max_clients: int = 8
 
 
 @dataclass
@@ -18,10 +33,29 @@ class RemoteConfig:
     camera_id: int = 0
     camera_resolution_width: int = 1600
     camera_resolution_height: int = 1200
+    camera_pixel_format: str = "MJPG"  # "MJPG" or "YUYV"
     camera_auto_exposure: int = 1
     camera_exposure: int = 1
     camera_gain: int = 25
     fiducial_size_m: float = 0.1651
+    detector_backend: str = "aruco"  # "aruco" or "apriltag"
+    detector_roi_tracking: bool = False
+    detector_full_scan_interval: int = 10
+    detector_decimation: int = 1
+    detector_tile_rows: int = 1
+    detector_tile_cols: int = 1
+    detector_tile_overlap: int = 200
+    detector_adaptive_params: bool = False
+    detector_wide_sweep_interval: int = 30
+    solver_warm_start: bool = False
+    solver_frame_budget_ms: float = 0.0  # 0 disables the cheap path
+    solver_cheap_max_tags: int = 4
+    solver_per_tag_poses: bool = False
+    solver_tag_threads: int = 1
+    apriltag_nthreads: int = 2
+    apriltag_quad_decimate: float = 2.0
+    apriltag_quad_sigma: float = 0.0
+    apriltag_refine_edges: bool = True
     tag_layout: any = ""
     tag_layout_name: any = "2025-reefscape.json"
 
@@ -30,3 +64,10 @@ class RemoteConfig:
 class ConfigStore:
     local_config: LocalConfig
     remote_config: RemoteConfig
+    remote_version: int = 0  # Incremented for each published remote config
+
+    def publish_remote_config(self, remote_config: RemoteConfig) -> None:
+        """Replace the remote config with a new snapshot. Published snapshots are never modified, so
+        consumers only need to compare versions to detect a change."""
+        self.remote_config = remote_config
+        self.remote_version += 1
@@ -7,7 +7,8 @@ from vision_types import CameraPoseObservation, FiducialPoseObservation
 
 
 class OutputPublisher:
-    def send(self, config_store: ConfigStore, timestamp: float, observation: Union[CameraPoseObservation, None], demo_observation: Union[FiducialPoseObservation, None], fps: Union[int, None] = None) -> None:
+    def send(self, config_store: ConfigStore, timestamp: float, observation: Union[CameraPoseObservation, None], demo_observation: Union[FiducialPoseObservation, None], fps: Union[int, None] = None,
+             tag_observations: List[FiducialPoseObservation] = []) -> None:
         raise NotImplementedError
 
 
@@ -15,9 +16,12 @@ class NTOutputPublisher(OutputPublisher):
     _init_complete: bool = False
     _observations_pub: ntcore.DoubleArrayPublisher
     _observations_pub: ntcore.DoubleArrayPublisher
+    _solver_decisions_pub: ntcore.DoubleArrayPublisher
+    _tag_observations_pub: ntcore.DoubleArrayPublisher
     _fps_pub: ntcore.IntegerPublisher
 
-    def send(self, config_store: ConfigStore, timestamp: float, observation: Union[CameraPoseObservation, None], demo_observation: Union[FiducialPoseObservation, None], fps: Union[int, None] = None) -> None:
+    def send(self, config_store: ConfigStore, timestamp: float, observation: Union[CameraPoseObservation, None], demo_observation: Union[FiducialPoseObservation, None], fps: Union[int, None] = None,
+             tag_observations: List[FiducialPoseObservation] = []) -> None:
         # Initialize publishers on first call
         if not self._init_complete:
             self._init_complete = True
@@ -27,6 +31,10 @@ class NTOutputPublisher(OutputPublisher):
                 ntcore.PubSubOptions(periodic=0, sendAll=True, keepDuplicates=True))
             self._demo_observations_pub = nt_table.getDoubleArrayTopic("demo_observations").publish(
                 ntcore.PubSubOptions(periodic=0, sendAll=True, keepDuplicates=True))
+            self._solver_decisions_pub = nt_table.getDoubleArrayTopic("solver_decisions").publish(
+                ntcore.PubSubOptions(periodic=0, sendAll=True, keepDuplicates=True))
+            self._tag_observations_pub = nt_table.getDoubleArrayTopic("tag_observations").publish(
+                ntcore.PubSubOptions(periodic=0, sendAll=True, keepDuplicates=True))
             self._fps_pub = nt_table.getIntegerTopic("fps").publish()
 
         # Send data
@@ -34,6 +42,7 @@ class NTOutputPublisher(OutputPublisher):
             self._fps_pub.set(fps)
         observation_data: List[float] = [0]
         demo_observation_data: List[float] = []
+        solver_decisions_data: List[float] = []
         if observation != None:
             observation_data[0] = 1
             observation_data.append(observation.error_0)
@@ -56,6 +65,12 @@ class NTOutputPublisher(OutputPublisher):
                 observation_data.append(observation.pose_1.rotation().getQuaternion().Z())
             for tag_id in observation.tag_ids:
                 observation_data.append(tag_id)
+
+            # Cheap path flag, then a (tag ID, reason) pair for each visible tag left out of the solve
+            solver_decisions_data.append(1 if observation.cheap_path else 0)
+            for tag_id, reason in observation.skipped_tags:
+                solver_decisions_data.append(tag_id)
+                solver_decisions_data.append(reason)
         if demo_observation != None:
             demo_observation_data.append(demo_observation.error_0)
             demo_observation_data.append(demo_observation.pose_0.translation().X())
@@ -75,3 +90,13 @@ class NTOutputPublisher(OutputPublisher):
             demo_observation_data.append(demo_observation.pose_1.rotation().getQuaternion().Z())
         self._observations_pub.set(observation_data, math.floor(timestamp * 1000000))
         self._demo_observations_pub.set(demo_observation_data, math.floor(timestamp * 1000000))
+        self._solver_decisions_pub.set(solver_decisions_data, math.floor(timestamp * 1000000))
+
+        # Per-tag poses, 17 values per tag: ID, then error, translation and quaternion of both solutions
+        tag_observation_data: List[float] = []
+        for tag_observation in tag_observations:
+            tag_observation_data.append(tag_observation.tag_id)
+            for error, pose in [(tag_observation.error_0, tag_observation.pose_0), (tag_observation.error_1, tag_observation.pose_1)]:
+                quaternion = pose.rotation().getQuaternion()
+                tag_observation_data += [error, pose.X(), pose.Y(), pose.Z(), quaternion.W(), quaternion.X(), quaternion.Y(), quaternion.Z()]
+        self._tag_observations_pub.set(tag_observation_data, math.floor(timestamp * 1000000))
@@ -0,0 +1,147 @@
+import threading
+import time
+from io import BytesIO
+from typing import Callable, Dict, List, Tuple, Union
+
+import cv2
+from PIL import Image
+
+from output.overlay_util import overlay_image_observation
+from vision_types import FiducialImageObservation
+
+STREAM_VIEWS = ["annotated", "raw", "thresholded"]
+
+
+class _StreamView:
+    def __init__(self) -> None:
+        self.jpeg = b""
+        self.generation = 0
+        self.client_count = 0
+
+
+class JpegBroadcastHub:
+    """Encodes each new frame once per view and shares the JPEG bytes with every stream client.
+
+    Frames are stored by reference together with their observations. Views are rendered on a
+    single thread, only while a client is watching that view, and no faster than "max_fps", so
+    overlay drawing and debug images cost nothing on the pose loop. Clients wait on the hub's
+    condition for a newer generation than the one they last sent, so every client gets each frame
+    at most once and encoding cost does not grow with the number of viewers.
+    """
+
+    PASSTHROUGH_TIMEOUT_SECS = 1.0
+
+    def __init__(self, max_fps: float, quality: int, scale: float) -> None:
+        self._min_interval = 1.0 / max_fps if max_fps > 0 else 0.0
+        self._quality = quality
+        self._scale = scale
+        self._condition = threading.Condition()
+        self._frame: Union[cv2.Mat, None] = None
+        self._observations: List[FiducialImageObservation] = []
+        self._views: Dict[str, _StreamView] = {view: _StreamView() for view in STREAM_VIEWS}
+        self._last_publish_time = 0.0
+        self._last_passthrough_time = 0.0
+        self._last_passthrough_publish_time = 0.0
+        self._listeners: List[Callable[[], None]] = []
+        threading.Thread(target=self._run_encoder, daemon=True).start()
+
+    def _passthrough_active(self) -> bool:
+        return time.time() - self._last_passthrough_time < self.PASSTHROUGH_TIMEOUT_SECS
+
+    def _publish(self, view: str, data: bytes) -> None:
+        self._views[view].jpeg = data
+        self._views[view].generation += 1
+        self._condition.notify_all()
+        for listener in self._listeners:
+            listener()
+
+    def _get_rendered_views(self) -> List[str]:
+        """Views with viewers that need rendering. The raw view comes from passthrough if active."""
+        return [view for view in STREAM_VIEWS if self._views[view].client_count > 0 and
+                not (view == "raw" and self._passthrough_active())]
+
+    def set_frame(self, frame: cv2.Mat, observations: List[FiducialImageObservation] = []) -> None:
+        """Offer a frame to render. The frame must not be modified afterwards."""
+        with self._condition:
+            self._frame = frame
+            self._observations = observations
+            self._condition.notify_all()
+
+    def set_jpeg(self, data: bytes) -> None:
+        """Offer an already encoded camera frame, which is shared as-is on the raw view."""
+        with self._condition:
+            now = time.time()
+            self._last_passthrough_time = now
+            if self._views["raw"].client_count > 0 and now - self._last_passthrough_publish_time >= self._min_interval:
+                self._publish("raw", data)
+                self._last_passthrough_publish_time = now
+
+    def add_client(self, view: str) -> None:
+        with self._condition:
+            self._views[view].client_count += 1
+            self._condition.notify_all()
+
+    def remove_client(self, view: str) -> None:
+        with self._condition:
+            self._views[view].client_count -= 1
+
+    def add_listener(self, listener: Callable[[], None]) -> None:
+        """Call "listener" from the publishing thread whenever a new frame is available."""
+        with self._condition:
+            self._listeners.append(listener)
+
+    def get_jpeg(self, view: str) -> Tuple[int, bytes]:
+        """Return the latest generation and frame of a view without waiting."""
+        with self._condition:
+            return self._views[view].generation, self._views[view].jpeg
+
+    def wait_for_jpeg(self, view: str, last_generation: int, timeout: float) -> Tuple[int, Union[bytes, None]]:
+        """Wait for a frame newer than "last_generation". Returns (generation, None) on timeout."""
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._views[view].generation > last_generation, timeout):
+                return last_generation, None
+            return self._views[view].generation, self._views[view].jpeg
+
+    def _render(self, view: str, frame: cv2.Mat, observations: List[FiducialImageObservation]) -> cv2.Mat:
+        if view == "annotated":
+            # Color is only needed here, so grayscale frames are converted lazily
+            if len(frame.shape) == 2:
+                frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+            else:
+                frame = frame.copy()
+            [overlay_image_observation(frame, x) for x in observations]
+        elif view == "thresholded":
+            if len(frame.shape) == 3:
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            frame = cv2.adaptiveThreshold(frame, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 13, 7)
+        return frame
+
+    def _encode(self, frame: cv2.Mat) -> bytes:
+        if self._scale != 1.0:
+            frame = cv2.resize(frame, None, fx=self._scale, fy=self._scale, interpolation=cv2.INTER_AREA)
+        stream = BytesIO()
+        Image.fromarray(frame).save(stream, format="JPEG", quality=self._quality)
+        return stream.getvalue()
+
+    def _run_encoder(self) -> None:
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._frame is not None and len(self._get_rendered_views()) > 0)
+                delay = self._last_publish_time + self._min_interval - time.time()
+            if delay > 0:
+                # Pace encoding, the newest frame at the end of the wait wins
+                time.sleep(delay)
+                continue
+
+            with self._condition:
+                frame = self._frame
+                observations = self._observations
+                views = self._get_rendered_views()
+                self._frame = None
+                self._last_publish_time = time.time()
+            if frame is None:
+                continue
+            for view in views:
+                data = self._encode(self._render(view, frame, observations))
+                with self._condition:
+                    self._publish(view, data)
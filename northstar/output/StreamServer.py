@@ -1,34 +1,21 @@
+import asyncio
+import json
 import socketserver
 import threading
 import time
+from collections import deque
+from dataclasses import dataclass, field
 from http.server import BaseHTTPRequestHandler, HTTPServer
-from io import BytesIO
+import urllib.parse
+from typing import Deque, List, Union
 
 import cv2
-from PIL import Image
 
 from config.config import ConfigStore
+from output.StreamHub import STREAM_VIEWS, JpegBroadcastHub
+from vision_types import FiducialImageObservation
 
-
-class StreamServer:
-    """Interface for outputing camera frames."""
-
-    def start(self, config_store: ConfigStore) -> None:
-        """Starts the output stream."""
-        raise NotImplementedError
-
-    def set_frame(self, frame: cv2.Mat) -> None:
-        """Sets the frame to serve."""
-        raise NotImplementedError
-
-
-class MjpegServer(StreamServer):
-    _frame: cv2.Mat
-    _has_frame: bool = False
-
-    def _make_handler(self_mjpeg):  # type: ignore
-        class StreamingHandler(BaseHTTPRequestHandler):
-            HTML = """
+DEBUG_PAGE_HTML = """
     <html>
         <head>
             <title>Northstar Debug</title>
@@ -51,7 +38,62 @@ class MjpegServer(StreamServer):
             <img src="stream.mjpg" />
         </body>
     </html>
-            """
+"""
+
+
+class StreamServer:
+    """Interface for outputing camera frames."""
+
+    def start(self, config_store: ConfigStore) -> None:
+        """Starts the output stream."""
+        raise NotImplementedError
+
+    def set_frame(self, frame: cv2.Mat, observations: List[FiducialImageObservation] = []) -> None:
+        """Sets the frame to serve and the observations to draw on annotated views."""
+        raise NotImplementedError
+
+    def set_jpeg(self, data: bytes) -> None:
+        """Sets an already encoded JPEG frame to serve on the raw view."""
+        raise NotImplementedError
+
+
+class _HubStreamServer(StreamServer):
+    """Stream server sharing frames through a JpegBroadcastHub."""
+
+    _hub: Union[JpegBroadcastHub, None] = None
+    _default_view: str = "annotated"
+
+    def _start_server(self, config_store: ConfigStore) -> None:
+        raise NotImplementedError
+
+    def _get_view(self, path: str) -> Union[str, None]:
+        """Return the view requested by a stream path, or None if the path is not a stream."""
+        url = urllib.parse.urlparse(path)
+        if url.path != "/stream.mjpg":
+            return None
+        view = urllib.parse.parse_qs(url.query).get("view", [self._default_view])[0]
+        return view if view in STREAM_VIEWS else None
+
+    def start(self, config_store: ConfigStore) -> None:
+        self._hub = JpegBroadcastHub(config_store.local_config.stream_max_fps,
+                                     config_store.local_config.stream_quality,
+                                     config_store.local_config.stream_scale)
+        if config_store.local_config.stream_passthrough:
+            self._default_view = "raw"
+        self._start_server(config_store)
+
+    def set_frame(self, frame: cv2.Mat, observations: List[FiducialImageObservation] = []) -> None:
+        self._hub.set_frame(frame, observations)
+
+    def set_jpeg(self, data: bytes) -> None:
+        self._hub.set_jpeg(data)
+
+
+class MjpegServer(_HubStreamServer):
+
+    def _make_handler(self_mjpeg):  # type: ignore
+        class StreamingHandler(BaseHTTPRequestHandler):
+            HTML = DEBUG_PAGE_HTML
 
             def do_GET(self):
                 if self.path == "/":
@@ -61,31 +103,32 @@ class MjpegServer(StreamServer):
                     self.send_header("Content-Length", str(len(content)))
                     self.end_headers()
                     self.wfile.write(content)
-                elif self.path == "/stream.mjpg":
+                elif self_mjpeg._get_view(self.path) != None:
+                    view = self_mjpeg._get_view(self.path)
                     self.send_response(200)
                     self.send_header("Age", "0")
                     self.send_header("Cache-Control", "no-cache, private")
                     self.send_header("Pragma", "no-cache")
                     self.send_header("Content-Type", "multipart/x-mixed-replace; boundary=FRAME")
                     self.end_headers()
+                    self_mjpeg._hub.add_client(view)
                     try:
+                        generation = 0
                         while True:
-                            if not self_mjpeg._has_frame:
-                                time.sleep(0.1)
-                            else:
-                                pil_im = Image.fromarray(self_mjpeg._frame)
-                                stream = BytesIO()
-                                pil_im.save(stream, format="JPEG")
-                                frame_data = stream.getvalue()
-
-                                self.wfile.write(b"--FRAME\r\n")
-                                self.send_header("Content-Type", "image/jpeg")
-                                self.send_header("Content-Length", str(len(frame_data)))
-                                self.end_headers()
-                                self.wfile.write(frame_data)
-                                self.wfile.write(b"\r\n")
+                            generation, frame_data = self_mjpeg._hub.wait_for_jpeg(view, generation, 0.5)
+                            if frame_data == None:
+                                continue
+
+                            self.wfile.write(b"--FRAME\r\n")
+                            self.send_header("Content-Type", "image/jpeg")
+                            self.send_header("Content-Length", str(len(frame_data)))
+                            self.end_headers()
+                            self.wfile.write(frame_data)
+                            self.wfile.write(b"\r\n")
                     except Exception as e:
-                        print("Removed streaming client %s: %s", self.client_address, str(e))
+                        print("Removed streaming client %s: %s" % (self.client_address, str(e)))
+                    finally:
+                        self_mjpeg._hub.remove_client(view)
                 else:
                     self.send_error(404)
                     self.end_headers()
@@ -100,9 +143,125 @@ class MjpegServer(StreamServer):
         server = self.StreamingServer(("", port), self._make_handler())
         server.serve_forever()
 
-    def start(self, config_store: ConfigStore) -> None:
+    def _start_server(self, config_store: ConfigStore) -> None:
         threading.Thread(target=self._run, daemon=True, args=(config_store.local_config.stream_port,)).start()
 
-    def set_frame(self, frame: cv2.Mat) -> None:
-        self._frame = frame.copy()
-        self._has_frame = True
+
+@dataclass
+class _StreamClient:
+    address: str
+    view: str
+    connected_time: float
+    frames_sent: int = 0
+    frames_skipped: int = 0
+    send_times: Deque[float] = field(default_factory=deque)
+
+    def record_frame(self, skipped: int) -> None:
+        self.frames_sent += 1
+        self.frames_skipped += skipped
+        self.send_times.append(time.time())
+
+    def get_fps(self) -> int:
+        """Frames sent during the last second."""
+        while len(self.send_times) > 0 and time.time() - self.send_times[0] > 1.0:
+            self.send_times.popleft()
+        return len(self.send_times)
+
+
+class AsyncMjpegServer(_HubStreamServer):
+    """MJPEG server on a single asyncio event loop, for many simultaneous viewers.
+
+    Each client only takes the newest frame once its previous write has drained, so a slow client
+    skips frames instead of queueing them and never holds an OS thread. "/status" lists the
+    connected clients and their effective frame rates.
+    """
+
+    _loop: Union[asyncio.AbstractEventLoop, None] = None
+    _frame_event: Union[asyncio.Event, None] = None
+
+    def __init__(self) -> None:
+        self._clients: List[_StreamClient] = []
+        self._max_clients = 0
+
+    def _on_new_frame(self) -> None:
+        # Runs on the event loop, waking every client waiting for this frame
+        self._frame_event.set()
+        self._frame_event = asyncio.Event()
+
+    async def _send_response(self, writer: asyncio.StreamWriter, status: str, content_type: str, content: bytes) -> None:
+        writer.write(("HTTP/1.1 " + status + "\r\nContent-Type: " + content_type + "\r\nContent-Length: " +
+                      str(len(content)) + "\r\nConnection: close\r\n\r\n").encode("utf-8") + content)
+        await writer.drain()
+
+    def _get_status(self) -> bytes:
+        now = time.time()
+        return json.dumps({
+            "max_clients": self._max_clients,
+            "clients": [{
+                "address": client.address,
+                "view": client.view,
+                "connected_secs": round(now - client.connected_time, 1),
+                "frames_sent": client.frames_sent,
+                "frames_skipped": client.frames_skipped,
+                "fps": client.get_fps()
+            } for client in self._clients]
+        }).encode("utf-8")
+
+    async def _stream(self, writer: asyncio.StreamWriter, client: _StreamClient) -> None:
+        writer.write(b"HTTP/1.1 200 OK\r\nAge: 0\r\nCache-Control: no-cache, private\r\nPragma: no-cache\r\n"
+                     b"Content-Type: multipart/x-mixed-replace; boundary=FRAME\r\n\r\n")
+        # Wait for each frame to leave the user-space buffer before taking the next one
+        writer.transport.set_write_buffer_limits(0)
+        generation = self._hub.get_jpeg(client.view)[0]
+        while True:
+            frame_event = self._frame_event
+            latest_generation, frame_data = self._hub.get_jpeg(client.view)
+            if latest_generation == generation:
+                await frame_event.wait()
+                continue
+
+            writer.write(b"--FRAME\r\nContent-Type: image/jpeg\r\nContent-Length: " +
+                         str(len(frame_data)).encode("utf-8") + b"\r\n\r\n" + frame_data + b"\r\n")
+            client.record_frame(max(0, latest_generation - generation - 1))
+            generation = latest_generation
+            await writer.drain()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        address = str(writer.get_extra_info("peername"))
+        try:
+            request = await reader.readuntil(b"\r\n\r\n")
+            path = request.split(b"\r\n")[0].split(b" ")[1].decode("utf-8")
+            if path == "/":
+                await self._send_response(writer, "200 OK", "text/html", DEBUG_PAGE_HTML.encode("utf-8"))
+            elif path == "/status":
+                await self._send_response(writer, "200 OK", "application/json", self._get_status())
+            elif self._get_view(path) != None:
+                if len(self._clients) >= self._max_clients:
+                    await self._send_response(writer, "503 Service Unavailable", "text/plain", b"Too many stream clients")
+                else:
+                    client = _StreamClient(address, self._get_view(path), time.time())
+                    self._clients.append(client)
+                    self._hub.add_client(client.view)
+                    try:
+                        await self._stream(writer, client)
+                    finally:
+                        self._clients.remove(client)
+                        self._hub.remove_client(client.view)
+            else:
+                await self._send_response(writer, "404 Not Found", "text/plain", b"Not found")
+        except Exception as e:
+            print("Removed streaming client %s: %s" % (address, str(e)))
+        finally:
+            writer.close()
+
+    async def _serve(self, port: int) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._frame_event = asyncio.Event()
+        self._hub.add_listener(lambda: self._loop.call_soon_threadsafe(self._on_new_frame))
+        server = await asyncio.start_server(self._handle, "", port, reuse_address=True)
+        async with server:
+            await server.serve_forever()
+
+    def _start_server(self, config_store: ConfigStore) -> None:
+        self._max_clients = config_store.local_config.stream_max_clients
+        threading.Thread(target=asyncio.run, daemon=True, args=(self._serve(config_store.local_config.stream_port),)).start()
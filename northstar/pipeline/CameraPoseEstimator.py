@@ -1,90 +1,72 @@
-from typing import List, Union
+import math
+import time
+from typing import List, Tuple, Union
 
 import cv2
 import numpy
-import json
+import numpy.typing
 
 from config.config import ConfigStore
-from vision_types import CameraPoseObservation, FiducialImageObservation
+from vision_types import (TAG_SKIPPED_CAPPED, TAG_SKIPPED_OBLIQUE,
+                          TAG_SKIPPED_SMALL, CameraPoseObservation,
+                          FiducialImageObservation)
 from wpimath.geometry import *
 
-from pipeline.coordinate_systems import (openCvPoseToWpilib,
-                                         wpilibTranslationToOpenCv)
+from pipeline import se3
+from pipeline.tag_layout import TagLayoutIndex, get_tag_layout, get_tag_layout_index
+from pipeline.undistortion import get_distortion_coefficients
 import os
 
 class CameraPoseEstimator:
     def __init__(self) -> None:
         raise NotImplementedError
 
-    def solve_camera_pose(self, image_observations: List[FiducialImageObservation], config_store: ConfigStore) -> Union[CameraPoseObservation, None]:
+    def solve_camera_pose(self, image_observations: List[FiducialImageObservation], config_store: ConfigStore,
+                          deadline: Union[float, None] = None) -> Union[CameraPoseObservation, None]:
+        """Solve for the camera pose. "deadline" is the wall clock time (time.time()) the frame is due by."""
         raise NotImplementedError
 
 
 class MultiTargetCameraPoseEstimator(CameraPoseEstimator):
+    WARM_START_ERROR_RATIO = 2.0  # Max growth of the reprojection error before falling back to the global solver
+    WARM_START_ERROR_MARGIN = 0.5  # Pixels, so noise on a near zero error does not force a fallback
+    WARM_START_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_COUNT, 5, 1e-6)
+    CHEAP_PATH_BUDGET_FRACTION = 0.75  # Take the cheap path once this much of the frame budget is used
+    CHEAP_PATH_MIN_TAG_SIZE = 20  # Mean side length in pixels
+    CHEAP_PATH_MIN_SHAPE_RATIO = 0.35  # Ratio of the shorter to the longer pair of opposite sides, about 70 degrees
+
     def __init__(self) -> None:
-        self.tag_layout = {}
-        if self.tag_layout == {} or True:
-            with open("2025-reefscape.json", 'r') as file:
-                self.tag_layout = json.load(file)
-                #print(self.tag_layout)
-            return None
-        pass
+        self._layout_index: Union[TagLayoutIndex, None] = None
+        self._previous_solution: Union[Tuple[List[int], numpy.typing.NDArray[numpy.float64], numpy.typing.NDArray[numpy.float64], float], None] = None
+
+    def solve_camera_pose(self, image_observations: List[FiducialImageObservation], config_store: ConfigStore,
+                          deadline: Union[float, None] = None) -> Union[CameraPoseObservation, None]:
+        tag_layout = get_tag_layout(config_store)
 
-    def solve_camera_pose(self, image_observations: List[FiducialImageObservation], config_store: ConfigStore) -> Union[CameraPoseObservation, None]:
-        # Exit if no tag layout available
-        #print("Tag layout: "+ str(self.tag_layout))
-        
         # Exit if no observations available
         #print(str(len(image_observations))+" observations")
         if len(image_observations) == 0:
             return None
 
-        # Create set of object and image points
+        # Object points come from the layout index, which is rebuilt only when the layout or tag size changes.
+        # A new layout is swapped in between frames, with one index build shared by all workers.
         fid_size = config_store.remote_config.fiducial_size_m
-        object_points = []
-        image_points = []
-        tag_ids = []
-        tag_poses = []
-        for observation in image_observations:
-            tag_pose = None
-            for tag_data in self.tag_layout["tags"]:
-                if tag_data["ID"] == observation.tag_id:
-                    tag_pose = Pose3d(
-                        Translation3d(
-                            tag_data["pose"]["translation"]["x"],
-                            tag_data["pose"]["translation"]["y"],
-                            tag_data["pose"]["translation"]["z"]
-                        ),
-                        Rotation3d(Quaternion(
-                            tag_data["pose"]["rotation"]["quaternion"]["W"],
-                            tag_data["pose"]["rotation"]["quaternion"]["X"],
-                            tag_data["pose"]["rotation"]["quaternion"]["Y"],
-                            tag_data["pose"]["rotation"]["quaternion"]["Z"]
-                        )))
-            if tag_pose != None:
-                # Add object points by transforming from the tag center
-                corner_0 = tag_pose + Transform3d(Translation3d(0, fid_size / 2.0, -fid_size / 2.0), Rotation3d())
-                corner_1 = tag_pose + Transform3d(Translation3d(0, -fid_size / 2.0, -fid_size / 2.0), Rotation3d())
-                corner_2 = tag_pose + Transform3d(Translation3d(0, -fid_size / 2.0, fid_size / 2.0), Rotation3d())
-                corner_3 = tag_pose + Transform3d(Translation3d(0, fid_size / 2.0, fid_size / 2.0), Rotation3d())
-                object_points += [
-                    wpilibTranslationToOpenCv(corner_0.translation()),
-                    wpilibTranslationToOpenCv(corner_1.translation()),
-                    wpilibTranslationToOpenCv(corner_2.translation()),
-                    wpilibTranslationToOpenCv(corner_3.translation())
-                ]
-
-                # Add image points from observation
-                image_points += [
-                    [observation.corners[0][0][0], observation.corners[0][0][1]],
-                    [observation.corners[0][1][0], observation.corners[0][1][1]],
-                    [observation.corners[0][2][0], observation.corners[0][2][1]],
-                    [observation.corners[0][3][0], observation.corners[0][3][1]]
-                ]
-
-                # Add tag ID and pose
-                tag_ids.append(observation.tag_id)
-                tag_poses.append(tag_pose)
+        if self._layout_index == None or not self._layout_index.matches(tag_layout, fid_size):
+            self._layout_index = get_tag_layout_index(tag_layout, fid_size)
+        known_observations = [x for x in image_observations if self._layout_index.has_tag(x.tag_id)]
+        if len(known_observations) == 0:
+            return None
+
+        # Once most of the frame budget is gone, solve with fewer, better conditioned tags
+        budget = config_store.remote_config.solver_frame_budget_ms / 1000.0
+        cheap_path = deadline != None and time.time() > deadline - budget * (1 - self.CHEAP_PATH_BUDGET_FRACTION)
+        skipped_tags: List[Tuple[int, int]] = []
+        if cheap_path:
+            known_observations, skipped_tags = self._select_cheap_path_tags(known_observations, config_store.remote_config.solver_cheap_max_tags)
+        tag_ids = [x.tag_id for x in known_observations]
+        object_points = self._layout_index.get_object_points(tag_ids)
+        image_points = numpy.concatenate([x.corners[0] for x in known_observations])
+        distortion_coefficients = get_distortion_coefficients(known_observations, config_store)
 
         # Single tag, return two poses
         #print(str(len(tag_ids))+" tags")
@@ -94,39 +76,91 @@ class MultiTargetCameraPoseEstimator(CameraPoseEstimator):
                                          [fid_size / 2.0, -fid_size / 2.0, 0.0],
                                          [-fid_size / 2.0, -fid_size / 2.0, 0.0]])
             try:
-                _, rvecs, tvecs, errors = cv2.solvePnPGeneric(object_points, numpy.array(image_points),
-                                                              config_store.local_config.camera_matrix, config_store.local_config.distortion_coefficients, flags=cv2.SOLVEPNP_IPPE_SQUARE)
+                _, rvecs, tvecs, errors = cv2.solvePnPGeneric(object_points, image_points,
+                                                              config_store.local_config.camera_matrix, distortion_coefficients, flags=cv2.SOLVEPNP_IPPE_SQUARE)
             except:
                 return None
 
             # Calculate WPILib camera poses
-            field_to_tag_pose = tag_poses[0]
-            camera_to_tag_pose_0 = openCvPoseToWpilib(tvecs[0], rvecs[0])
-            camera_to_tag_pose_1 = openCvPoseToWpilib(tvecs[1], rvecs[1])
+            field_to_tag_pose = self._layout_index.tag_poses[tag_ids[0]]
+            camera_to_tag_pose_0 = se3.opencv_to_pose3d(rvecs[0], tvecs[0])
+            camera_to_tag_pose_1 = se3.opencv_to_pose3d(rvecs[1], tvecs[1])
             camera_to_tag_0 = Transform3d(camera_to_tag_pose_0.translation(), camera_to_tag_pose_0.rotation())
             camera_to_tag_1 = Transform3d(camera_to_tag_pose_1.translation(), camera_to_tag_pose_1.rotation())
-            field_to_camera_0 = field_to_tag_pose.transformBy(camera_to_tag_0.inverse())
-            field_to_camera_1 = field_to_tag_pose.transformBy(camera_to_tag_1.inverse())
-            field_to_camera_pose_0 = Pose3d(field_to_camera_0.translation(), field_to_camera_0.rotation())
-            field_to_camera_pose_1 = Pose3d(field_to_camera_1.translation(), field_to_camera_1.rotation())
+            field_to_camera_pose_0 = field_to_tag_pose.transformBy(camera_to_tag_0.inverse())
+            field_to_camera_pose_1 = field_to_tag_pose.transformBy(camera_to_tag_1.inverse())
 
             # Return result
-            return CameraPoseObservation(tag_ids, field_to_camera_pose_0, errors[0][0], field_to_camera_pose_1, errors[1][0])
+            return CameraPoseObservation(tag_ids, field_to_camera_pose_0, errors[0][0], field_to_camera_pose_1, errors[1][0], cheap_path, skipped_tags)
 
         # Multi-tag, return one pose
         else:
-            # Run SolvePNP with all tags
-            try:
-                _, rvecs, tvecs, errors = cv2.solvePnPGeneric(numpy.array(object_points), numpy.array(image_points),
-                                                              config_store.local_config.camera_matrix, config_store.local_config.distortion_coefficients, flags=cv2.SOLVEPNP_SQPNP)
-            except:
-                return None
+            # Run SolvePNP with all tags, refining the previous frame's solution if the same tags are visible
+            tag_set = sorted(tag_ids)
+            solution = None
+            if config_store.remote_config.solver_warm_start and self._previous_solution != None and self._previous_solution[0] == tag_set:
+                solution = self._refine_previous_solution(object_points, image_points, distortion_coefficients, config_store)
+            if solution == None:
+                try:
+                    _, rvecs, tvecs, errors = cv2.solvePnPGeneric(object_points, image_points,
+                                                                  config_store.local_config.camera_matrix, distortion_coefficients, flags=cv2.SOLVEPNP_SQPNP)
+                except:
+                    self._previous_solution = None
+                    return None
+                solution = (rvecs[0], tvecs[0], errors[0][0])
+            rvec, tvec, error = solution
+            self._previous_solution = (tag_set, rvec, tvec, error)
 
             # Calculate WPILib camera pose
-            camera_to_field_pose = openCvPoseToWpilib(tvecs[0], rvecs[0])
+            camera_to_field_pose = se3.opencv_to_pose3d(rvec, tvec)
             camera_to_field = Transform3d(camera_to_field_pose.translation(), camera_to_field_pose.rotation())
             field_to_camera = camera_to_field.inverse()
             field_to_camera_pose = Pose3d(field_to_camera.translation(), field_to_camera.rotation())
 
             # Return result
-            return CameraPoseObservation(tag_ids, field_to_camera_pose, errors[0][0], None, None)
+            return CameraPoseObservation(tag_ids, field_to_camera_pose, error, None, None, cheap_path, skipped_tags)
+
+    def _select_cheap_path_tags(self, image_observations: List[FiducialImageObservation],
+                                max_tags: int) -> Tuple[List[FiducialImageObservation], List[Tuple[int, int]]]:
+        """Drop tiny and highly oblique tags, then keep the best conditioned ones up to "max_tags".
+
+        If every tag would be dropped, they are all ranked instead, so the frame still gets a pose.
+        """
+        ranked: List[Tuple[float, FiducialImageObservation]] = []
+        skipped_tags: List[Tuple[int, int]] = []
+        for observation in image_observations:
+            corners = observation.corners[0]
+            sides = numpy.linalg.norm(corners - numpy.roll(corners, 1, axis=0), axis=1)
+            size = float(sides.mean())
+            # Viewed at an angle, one pair of opposite sides is foreshortened relative to the other
+            shape_ratio = float(min(sides[0] + sides[2], sides[1] + sides[3]) / max(sides[0] + sides[2], sides[1] + sides[3], 1e-6))
+            if size < self.CHEAP_PATH_MIN_TAG_SIZE:
+                skipped_tags.append((observation.tag_id, TAG_SKIPPED_SMALL))
+            elif shape_ratio < self.CHEAP_PATH_MIN_SHAPE_RATIO:
+                skipped_tags.append((observation.tag_id, TAG_SKIPPED_OBLIQUE))
+            else:
+                ranked.append((size * size * shape_ratio, observation))
+        if len(ranked) == 0:
+            skipped_tags = []
+            ranked = [(float(cv2.contourArea(x.corners[0])), x) for x in image_observations]
+
+        ranked.sort(key=lambda x: x[0], reverse=True)
+        skipped_tags += [(x[1].tag_id, TAG_SKIPPED_CAPPED) for x in ranked[max(1, max_tags):]]
+        return [x[1] for x in ranked[:max(1, max_tags)]], skipped_tags
+
+    def _refine_previous_solution(self, object_points: numpy.typing.NDArray[numpy.float64], image_points: numpy.typing.NDArray[numpy.float32],
+                                  distortion_coefficients: numpy.typing.NDArray[numpy.float64], config_store: ConfigStore) -> Union[Tuple[numpy.typing.NDArray[numpy.float64], numpy.typing.NDArray[numpy.float64], float], None]:
+        """Refine the previous frame's solution with LM. Returns None if the reprojection error jumped."""
+        _, rvec, tvec, previous_error = self._previous_solution
+        try:
+            rvec, tvec = cv2.solvePnPRefineLM(object_points, image_points, config_store.local_config.camera_matrix,
+                                              distortion_coefficients, rvec.copy(), tvec.copy(), self.WARM_START_CRITERIA)
+        except:
+            return None
+
+        # RMS error per coordinate, matching solvePnPGeneric
+        projected_points, _ = cv2.projectPoints(object_points, rvec, tvec, config_store.local_config.camera_matrix, distortion_coefficients)
+        error = math.sqrt(numpy.sum(numpy.square(projected_points.reshape(-1, 2) - image_points)) / (2 * len(image_points)))
+        if error > previous_error * self.WARM_START_ERROR_RATIO + self.WARM_START_ERROR_MARGIN:
+            return None
+        return rvec, tvec, error
@@ -1,12 +1,15 @@
-import dataclasses
+import os
 import sys
+import threading
 import time
-from typing import Tuple
+from typing import Callable, Tuple, Union
 
 import cv2
 import numpy
 from config.config import ConfigStore
 
+from pipeline import v4l2_util
+
 
 class Capture:
     """Interface for receiving camera frames."""
@@ -18,8 +21,49 @@ class Capture:
         """Return the next frame from the camera."""
         raise NotImplementedError
 
+    _stamped_sequence: int = 0
+
+    def get_stamped_frame(self, config_store: ConfigStore) -> Tuple[bool, cv2.Mat, int, float]:
+        """Return the next frame along with its sequence number and capture time."""
+        timestamp = time.time()
+        retval, image = self.get_frame(config_store)
+        if retval:
+            self._stamped_sequence += 1
+        return retval, image, self._stamped_sequence, timestamp
+
+    def get_dropped_count(self) -> int:
+        """Return the number of captured frames that were never delivered."""
+        return 0
+
+    def set_jpeg_listener(self, listener: Callable[[bytes], None]) -> None:
+        """Receive the camera's original JPEG frames, if the capture can provide them."""
+        pass
+
+    @classmethod
+    def _snapshot_config(cls, config_store: ConfigStore) -> ConfigStore:
+        """Keep the current remote snapshot to diff against later. Snapshots are never modified, so no copy is needed."""
+        return ConfigStore(config_store.local_config, config_store.remote_config, config_store.remote_version)
+
     @classmethod
     def _config_changed(cls, config_a: ConfigStore, config_b: ConfigStore) -> bool:
+        return cls._session_config_changed(config_a, config_b) or cls._controls_changed(config_a, config_b)
+
+    @classmethod
+    def _session_config_changed(cls, config_a: ConfigStore, config_b: ConfigStore) -> bool:
+        """Whether the change needs a new capture session (camera, resolution or pixel format)."""
+        if config_a == None and config_b == None:
+            return False
+        if config_a == None or config_b == None:
+            return True
+
+        remote_a = config_a.remote_config
+        remote_b = config_b.remote_config
+
+        return remote_a.camera_id != remote_b.camera_id or remote_a.camera_resolution_width != remote_b.camera_resolution_width or remote_a.camera_resolution_height != remote_b.camera_resolution_height or remote_a.camera_pixel_format != remote_b.camera_pixel_format
+
+    @classmethod
+    def _controls_changed(cls, config_a: ConfigStore, config_b: ConfigStore) -> bool:
+        """Whether a camera control (exposure or gain) changed."""
         if config_a == None and config_b == None:
             return False
         if config_a == None or config_b == None:
@@ -28,7 +72,7 @@ class Capture:
         remote_a = config_a.remote_config
         remote_b = config_b.remote_config
 
-        return remote_a.camera_id != remote_b.camera_id or remote_a.camera_resolution_width != remote_b.camera_resolution_width or remote_a.camera_resolution_height != remote_b.camera_resolution_height or remote_a.camera_auto_exposure != remote_b.camera_auto_exposure or remote_a.camera_exposure != remote_b.camera_exposure or remote_a.camera_gain != remote_b.camera_gain
+        return remote_a.camera_auto_exposure != remote_b.camera_auto_exposure or remote_a.camera_exposure != remote_b.camera_exposure or remote_a.camera_gain != remote_b.camera_gain
 
 
 class DefaultCapture(Capture):
@@ -38,10 +82,11 @@ class DefaultCapture(Capture):
         pass
 
     _video = None
-    _last_config: ConfigStore
+    _last_config: Union[ConfigStore, None] = None
 
     def get_frame(self, config_store: ConfigStore) -> Tuple[bool, cv2.Mat]:
-        if self._video != None and self._config_changed(self._last_config, config_store):
+        if self._video != None and self._last_config.remote_version != config_store.remote_version and \
+                self._config_changed(self._last_config, config_store):
             print("Restarting capture session")
             self._video.release()
             self._video = None
@@ -54,12 +99,54 @@ class DefaultCapture(Capture):
             self._video.set(cv2.CAP_PROP_EXPOSURE, config_store.remote_config.camera_exposure)
             self._video.set(cv2.CAP_PROP_GAIN, config_store.remote_config.camera_gain)
 
-        self._last_config = config_store
+        if self._last_config == None or self._last_config.remote_version != config_store.remote_version:
+            self._last_config = self._snapshot_config(config_store)
 
         retval, image = self._video.read()
         return retval, image
 
 
+class _JpegPassthrough:
+    """Reads the camera's original JPEG frames from a multipartmux branch written to a pipe."""
+
+    def __init__(self, listener: Callable[[bytes], None]) -> None:
+        self._listener = listener
+        self._read_fd, self.write_fd = os.pipe()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self) -> None:
+        with os.fdopen(self._read_fd, "rb") as stream:
+            while True:
+                # Skip to the next boundary, then parse the part headers
+                line = stream.readline()
+                if line == b"":
+                    return
+                if not line.startswith(b"--"):
+                    continue
+                content_length = None
+                while True:
+                    header = stream.readline()
+                    if header == b"":
+                        return
+                    header = header.strip()
+                    if header == b"":
+                        break
+                    name, _, value = header.partition(b":")
+                    if name.strip().lower() == b"content-length":
+                        content_length = int(value)
+                if content_length == None:
+                    continue
+
+                data = stream.read(content_length)
+                if len(data) < content_length:
+                    return
+                self._listener(data)
+
+    def close(self) -> None:
+        """Close the write end once the pipeline is released, which ends the reader thread."""
+        os.close(self.write_fd)
+
+
 class GStreamerCapture(Capture):
     """"Read from camera with GStreamer."""
 
@@ -67,13 +154,63 @@ class GStreamerCapture(Capture):
         pass
 
     _video = None
-    _last_config: ConfigStore
+    _last_config: Union[ConfigStore, None] = None
+    _jpeg_listener: Union[Callable[[bytes], None], None] = None
+    _passthrough: Union[_JpegPassthrough, None] = None
+
+    def set_jpeg_listener(self, listener: Callable[[bytes], None]) -> None:
+        self._jpeg_listener = listener
+
+    @classmethod
+    def _get_pipeline(cls, config_store: ConfigStore, jpeg_fd: Union[int, None] = None) -> str:
+        source = "v4l2src device=/dev/video" + str(config_store.remote_config.camera_id) + " extra_controls=\"c,exposure_auto=" + str(config_store.remote_config.camera_auto_exposure) + ",exposure_absolute=" + str(
+            config_store.remote_config.camera_exposure) + ",gain=" + str(config_store.remote_config.camera_gain) + ",sharpness=0,brightness=0\""
+        size = ",width=" + str(config_store.remote_config.camera_resolution_width) + \
+            ",height=" + str(config_store.remote_config.camera_resolution_height)
+        if config_store.remote_config.camera_pixel_format == "YUYV":
+            # Raw frames cost more USB bandwidth but need no decoding
+            decode = "video/x-raw,format=YUY2" + size
+        elif jpeg_fd != None:
+            # Tee the camera's JPEG buffers to the stream server before decoding them for detection
+            decode = "image/jpeg" + size + " ! tee name=t t. ! queue leaky=downstream max-size-buffers=1 ! multipartmux boundary=FRAME ! fdsink fd=" + \
+                str(jpeg_fd) + " sync=false t. ! queue ! jpegdec"
+        else:
+            decode = "image/jpeg" + size + " ! jpegdec"
+        if config_store.local_config.capture_format == "GRAY8":
+            # Detection only needs luminance, so take the Y plane and skip building a BGR image
+            output = "videoconvert ! video/x-raw,format=GRAY8"
+        else:
+            output = "videoconvert"
+        return source + " ! " + decode + " ! " + output + " ! appsink drop=1"
+
+    def _release(self) -> None:
+        self._video.release()
+        self._video = None
+        if self._passthrough != None:
+            self._passthrough.close()
+            self._passthrough = None
+
+    def _apply_controls(self, config_store: ConfigStore) -> bool:
+        """Update exposure and gain on the open device. Returns False if the driver rejected them."""
+        start_time = time.perf_counter()
+        try:
+            v4l2_util.set_controls(config_store.remote_config.camera_id, [
+                (v4l2_util.V4L2_CID_EXPOSURE_AUTO, config_store.remote_config.camera_auto_exposure),
+                (v4l2_util.V4L2_CID_EXPOSURE_ABSOLUTE, config_store.remote_config.camera_exposure),
+                (v4l2_util.V4L2_CID_GAIN, config_store.remote_config.camera_gain)
+            ])
+        except OSError as e:
+            print("Failed to apply camera controls:", e)
+            return False
+        print("Applied camera controls in", round((time.perf_counter() - start_time) * 1000, 2), "ms")
+        return True
 
     def get_frame(self, config_store: ConfigStore) -> Tuple[bool, cv2.Mat]:
-        if self._video != None and self._config_changed(self._last_config, config_store):
+        # Exposure and gain are applied live, falling back to a restart if the driver rejects them. Only
+        # a new remote config version can hold a change.
+        if self._video != None and self._last_config.remote_version != config_store.remote_version and (self._session_config_changed(self._last_config, config_store) or (self._controls_changed(self._last_config, config_store) and not self._apply_controls(config_store))):
             print("Config changed, stopping capture session")
-            self._video.release()
-            self._video = None
+            self._release()
             time.sleep(2)
 
         if self._video == None:
@@ -81,20 +218,88 @@ class GStreamerCapture(Capture):
                 print("No camera ID, waiting to start capture session")
             else:
                 print("Starting capture session")
-                self._video = cv2.VideoCapture("v4l2src device=/dev/video" + str(config_store.remote_config.camera_id) + " extra_controls=\"c,exposure_auto=" + str(config_store.remote_config.camera_auto_exposure) + ",exposure_absolute=" + str(
-                    config_store.remote_config.camera_exposure) + ",gain=" + str(config_store.remote_config.camera_gain) + ",sharpness=0,brightness=0\" ! jpegdec ! videoconvert ! appsink drop=1", cv2.CAP_GSTREAMER)
+                jpeg_fd = None
+                if self._jpeg_listener != None and config_store.remote_config.camera_pixel_format == "MJPG":
+                    self._passthrough = _JpegPassthrough(self._jpeg_listener)
+                    jpeg_fd = self._passthrough.write_fd
+                self._video = cv2.VideoCapture(self._get_pipeline(config_store, jpeg_fd), cv2.CAP_GSTREAMER)
                 print("Capture session ready")
 
-        self._last_config = ConfigStore(dataclasses.replace(config_store.local_config),
-                                        dataclasses.replace(config_store.remote_config))
+        if self._last_config == None or self._last_config.remote_version != config_store.remote_version:
+            self._last_config = self._snapshot_config(config_store)
 
         if self._video != None:
             retval, image = self._video.read()
             if not retval:
                 print("Capture session failed, restarting")
-                self._video.release()
-                self._video = None  # Force reconnect
+                self._release()  # Force reconnect
                 sys.exit(1)
             return retval, image
         else:
             return False, cv2.Mat(numpy.ndarray([]))
+
+
+class FreshestFrameCapture(Capture):
+    """Drains another capture on a dedicated thread so the newest frame is always ready."""
+
+    def __init__(self, capture: Capture) -> None:
+        self._capture = capture
+        self._condition = threading.Condition()
+        self._thread: Union[threading.Thread, None] = None
+        self._config_store: Union[ConfigStore, None] = None
+        self._error: Union[BaseException, None] = None
+        self._image: Union[cv2.Mat, None] = None
+        self._sequence = 0
+        self._timestamp = 0.0
+        self._delivered_sequence = 0
+        self._dropped_count = 0
+
+    def _run(self) -> None:
+        try:
+            while True:
+                with self._condition:
+                    config_store = self._config_store
+                retval, image = self._capture.get_frame(config_store)
+                timestamp = time.time()
+                if not retval:
+                    time.sleep(0.1)
+                    continue
+                with self._condition:
+                    if self._sequence > self._delivered_sequence:
+                        self._dropped_count += 1
+                    self._image = image
+                    self._sequence += 1
+                    self._timestamp = timestamp
+                    self._condition.notify_all()
+        except BaseException as e:
+            # Re-raised on the caller's thread so capture failures still stop the process
+            with self._condition:
+                self._error = e
+                self._condition.notify_all()
+
+    def set_jpeg_listener(self, listener: Callable[[bytes], None]) -> None:
+        self._capture.set_jpeg_listener(listener)
+
+    def get_frame(self, config_store: ConfigStore) -> Tuple[bool, cv2.Mat]:
+        retval, image, _, _ = self.get_stamped_frame(config_store)
+        return retval, image
+
+    def get_stamped_frame(self, config_store: ConfigStore) -> Tuple[bool, cv2.Mat, int, float]:
+        with self._condition:
+            self._config_store = config_store
+            if self._thread == None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+            # Return immediately if a new frame is buffered, otherwise wait briefly for one
+            self._condition.wait_for(lambda: self._error != None or self._sequence > self._delivered_sequence, 1.0)
+            if self._error != None:
+                raise self._error
+            if self._sequence <= self._delivered_sequence:
+                return False, cv2.Mat(numpy.ndarray([])), self._delivered_sequence, 0.0
+            self._delivered_sequence = self._sequence
+            return True, self._image, self._sequence, self._timestamp
+
+    def get_dropped_count(self) -> int:
+        with self._condition:
+            return self._dropped_count
@@ -1,25 +1,328 @@
-from typing import List
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Deque, Dict, List, Tuple, Union
 
 import cv2
+import numpy
+import numpy.typing
 from config.config import ConfigStore
+from pipeline.detector_params import load_detector_param_values, make_detector_params
+from pipeline.tag_layout import get_tag_ids, get_tag_layout
 from vision_types import FiducialImageObservation
 
+try:
+    import pupil_apriltags
+except ImportError:
+    pupil_apriltags = None
+
 
 class FiducialDetector:
     def __init__(self) -> None:
         raise NotImplementedError
 
-    def detect_fiducials(self, image: cv2.Mat, config_store: ConfigStore) -> List[FiducialImageObservation]:
+    def detect_fiducials(self, image: cv2.Mat, config_store: ConfigStore, sequence: Union[int, None] = None) -> List[FiducialImageObservation]:
+        """Detect the tags in an image. "sequence" is the capture sequence number of the frame."""
         raise NotImplementedError
 
 
+class TagTracker:
+    """Tags found on recent frames, for searching only around them (ROI tracking).
+
+    The pipeline workers process frames concurrently, so each one only sees some of the frames. One
+    tracker is shared by all their detectors and keyed by capture sequence number: positions are
+    predicted across the actual gap in frames, and full scans are counted in camera frames.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._sequence: Union[int, None] = None  # Frame the tracks were found on
+        self._full_scan_sequence: Union[int, None] = None
+        # Velocity in pixels per frame (None after the first sighting) and corners of each tag
+        self._tracks: Dict[int, Tuple[Union[numpy.typing.NDArray[numpy.float32], None], numpy.typing.NDArray[numpy.float32]]] = {}
+
+    def predict(self, sequence: int, full_scan_interval: int) -> Union[Dict[int, Tuple[numpy.typing.NDArray[numpy.float32], numpy.typing.NDArray[numpy.float32]]], None]:
+        """Last and predicted corners of each tracked tag on frame "sequence", or None if a full scan is due.
+
+        The first frame to find a full scan due claims it, so concurrent workers do not all scan the
+        full frame.
+        """
+        with self._lock:
+            if len(self._tracks) == 0 or self._full_scan_sequence == None or \
+                    sequence - self._full_scan_sequence >= full_scan_interval:
+                self._full_scan_sequence = sequence
+                return None
+            gap = sequence - self._sequence
+            return {tag_id: (corners, corners if velocity is None else corners + velocity * gap)
+                    for tag_id, (velocity, corners) in self._tracks.items()}
+
+    def update(self, sequence: int, observations: List[FiducialImageObservation], full_scan: bool) -> None:
+        """Record the tags found on a frame. Results of frames older than the tracks are ignored."""
+        with self._lock:
+            if full_scan and (self._full_scan_sequence == None or sequence > self._full_scan_sequence):
+                self._full_scan_sequence = sequence
+            if self._sequence != None and sequence <= self._sequence:
+                return
+            gap = sequence - self._sequence if self._sequence != None else 0
+            self._tracks = {observation.tag_id: ((observation.corners - self._tracks[observation.tag_id][1]) / gap
+                                                 if observation.tag_id in self._tracks else None, observation.corners)
+                            for observation in observations}
+            self._sequence = sequence
+
+    def clear(self) -> None:
+        with self._lock:
+            self._tracks = {}
+
+
 class ArucoFiducialDetector(FiducialDetector):
-    def __init__(self, dictionary_id) -> None:
-        self._aruco_dict = cv2.aruco.Dictionary_get(dictionary_id)
-        self._aruco_params = cv2.aruco.DetectorParameters_create()
-
-    def detect_fiducials(self, image: cv2.Mat, config_store: ConfigStore) -> List[FiducialImageObservation]:
-        corners, ids, _ = cv2.aruco.detectMarkers(image, self._aruco_dict, parameters=self._aruco_params)
-        if len(corners) == 0:
-            return []
-        return [FiducialImageObservation(id[0], corner) for id, corner in zip(ids, corners)]
+    ROI_PADDING = 0.5  # Padding around predicted tags, as a fraction of the tag size
+    ROI_MIN_PADDING_PX = 16
+    SUBPIX_MIN_WINDOW = 3
+    SUBPIX_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.01)
+    DUPLICATE_DISTANCE = 0.1  # Max mean corner distance between duplicates, as a fraction of the tag size
+    ADAPTIVE_HISTORY_FRAMES = 30
+    ADAPTIVE_PERIMETER_MARGIN = 0.5  # Range kept around recent tag perimeters, as a fraction
+
+    def __init__(self, dictionary_id, extra_tag_ids: Union[List[int], None] = None, tracker: Union[TagTracker, None] = None) -> None:
+        """With "extra_tag_ids", only the tags in the active field layout plus these are decoded.
+
+        Detectors running on different workers of one pipeline should share a "tracker" and be given
+        each frame's sequence number.
+        """
+        self._base_dictionary_id = dictionary_id
+        self._base_aruco_dict = cv2.aruco.Dictionary_get(dictionary_id)
+        self._aruco_dict = self._base_aruco_dict
+        self._extra_tag_ids = extra_tag_ids
+        self._tag_ids: Union[numpy.typing.NDArray[numpy.int32], None] = None
+        self._aruco_param_values = load_detector_param_values()
+        self._aruco_params = make_detector_params(self._aruco_param_values)
+        self._tracker = tracker if tracker != None else TagTracker()
+        self._frame_count = 0
+        self._executor: Union[ThreadPoolExecutor, None] = None
+        self._executor_size = 0
+        self._recent_perimeters: Deque[Tuple[float, float]] = deque(maxlen=self.ADAPTIVE_HISTORY_FRAMES)
+        self._perimeter_range: Union[Tuple[float, float], None] = None
+        self._frames_since_wide_sweep = 0
+
+    def detect_fiducials(self, image: cv2.Mat, config_store: ConfigStore, sequence: Union[int, None] = None) -> List[FiducialImageObservation]:
+        # In tracking mode, search only around the tags seen on previous frames until a tag is lost
+        # or a periodic full scan is due. Without sequence numbers, every call is the next frame.
+        if sequence == None:
+            self._frame_count += 1
+            sequence = self._frame_count
+        decimation = max(1, config_store.remote_config.detector_decimation)
+        if self._extra_tag_ids != None:
+            self._update_dictionary(config_store)
+
+        # With adaptive parameters, only search for tags around the sizes seen on recent frames until
+        # a periodic wide sweep is due (so new distant tags are still found)
+        self._perimeter_range = None
+        if config_store.remote_config.detector_adaptive_params and len(self._recent_perimeters) > 0 and \
+                self._frames_since_wide_sweep < config_store.remote_config.detector_wide_sweep_interval:
+            self._perimeter_range = (min([x[0] for x in self._recent_perimeters]) * (1 - self.ADAPTIVE_PERIMETER_MARGIN),
+                                     max([x[1] for x in self._recent_perimeters]) * (1 + self.ADAPTIVE_PERIMETER_MARGIN))
+            self._frames_since_wide_sweep += 1
+        else:
+            self._frames_since_wide_sweep = 0
+
+        # A wide sweep always scans the full frame, since the new tags it looks for are outside the
+        # tracked regions. Narrowed full scans alone would never find them.
+        wide_sweep = config_store.remote_config.detector_adaptive_params and self._perimeter_range == None
+        observations = None
+        if config_store.remote_config.detector_roi_tracking and not wide_sweep:
+            tracks = self._tracker.predict(sequence, config_store.remote_config.detector_full_scan_interval)
+            if tracks != None:
+                observations = self._detect_tracked(image, tracks, decimation)
+        full_scan = observations == None
+        if full_scan:
+            rows = max(1, config_store.remote_config.detector_tile_rows)
+            cols = max(1, config_store.remote_config.detector_tile_cols)
+            if rows * cols > 1:
+                observations = self._detect_tiled(image, rows, cols, config_store.remote_config.detector_tile_overlap, decimation)
+            else:
+                observations = self._detect_region(image, 0, 0, decimation)
+
+        self._tracker.update(sequence, observations, full_scan)
+        if len(observations) > 0:
+            perimeters = [cv2.arcLength(observation.corners[0], True) for observation in observations]
+            self._recent_perimeters.append((min(perimeters), max(perimeters)))
+        elif self._perimeter_range != None:
+            # Nothing found at the recent sizes, so sweep widely on the next frame
+            self._recent_perimeters.clear()
+        return observations
+
+    def _update_dictionary(self, config_store: ConfigStore) -> None:
+        """Restrict decoding to the layout's tags, rebuilding the reduced dictionary if they changed.
+
+        Fewer codewords make matching cheaper, and tags that are not on the field never reach the
+        pose estimators. Detected indices are mapped back to tag IDs through "_tag_ids".
+        """
+        tag_ids = sorted(set(get_tag_ids(get_tag_layout(config_store)) + self._extra_tag_ids))
+        tag_ids = [x for x in tag_ids if 0 <= x < len(self._base_aruco_dict.bytesList)]
+        if self._tag_ids is not None and tag_ids == self._tag_ids.tolist():
+            return
+        self._aruco_dict = cv2.aruco.Dictionary_get(self._base_dictionary_id)
+        self._aruco_dict.bytesList = numpy.ascontiguousarray(self._base_aruco_dict.bytesList[tag_ids])
+        self._tag_ids = numpy.array(tag_ids, dtype=numpy.int32)
+        self._tracker.clear()
+
+    def _get_params(self, image: cv2.Mat, decimation: int) -> cv2.aruco.DetectorParameters:
+        """Detector parameters for searching an image, narrowed to the recent tag sizes if adaptive."""
+        if self._perimeter_range == None:
+            return self._aruco_params
+        min_perimeter = self._perimeter_range[0] / decimation
+        max_perimeter = self._perimeter_range[1] / decimation
+
+        # Threshold windows are matched to the size of one tag module (bit), including the black border
+        modules = 4 * (self._aruco_dict.markerSize + 2)
+        min_window = self._get_window_size(min_perimeter / modules)
+        max_window = max(min_window, self._get_window_size(max_perimeter / modules))
+
+        # Perimeter rates are relative to the largest dimension of the searched image
+        image_size = max(image.shape[0], image.shape[1])
+        return make_detector_params({
+            **self._aruco_param_values,
+            "adaptiveThreshWinSizeMin": min_window,
+            "adaptiveThreshWinSizeMax": max_window,
+            "minMarkerPerimeterRate": max(self._aruco_params.minMarkerPerimeterRate, min_perimeter / image_size),
+            "maxMarkerPerimeterRate": min(self._aruco_params.maxMarkerPerimeterRate, max_perimeter / image_size),
+        })
+
+    def _get_window_size(self, size: float) -> int:
+        """The odd threshold window size nearest "size", within the configured window range."""
+        size = min(max(size, self._aruco_params.adaptiveThreshWinSizeMin), self._aruco_params.adaptiveThreshWinSizeMax)
+        return int(size) // 2 * 2 + 1
+
+    def _detect_region(self, image: cv2.Mat, x: int, y: int, decimation: int) -> List[FiducialImageObservation]:
+        """Detect fiducials in an image region whose top left corner is at (x, y) in the full frame.
+
+        With decimation, quads are found on a downscaled copy and their corners are then refined to
+        subpixel accuracy on the full resolution region.
+        """
+        if decimation > 1:
+            small_image = cv2.resize(image, None, fx=1.0 / decimation, fy=1.0 / decimation, interpolation=cv2.INTER_AREA)
+            corners, ids, _ = cv2.aruco.detectMarkers(small_image, self._aruco_dict,
+                                                      parameters=self._get_params(small_image, decimation))
+            if len(corners) == 0:
+                return []
+            gray_image = image if len(image.shape) == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+            points = (numpy.concatenate(corners).reshape(-1, 1, 2) + 0.5) * decimation - 0.5
+            window = max(self.SUBPIX_MIN_WINDOW, 2 * decimation)
+            cv2.cornerSubPix(gray_image, points, (window, window), (-1, -1), self.SUBPIX_CRITERIA)
+            corners = points.reshape(-1, 1, 4, 2)
+        else:
+            corners, ids, _ = cv2.aruco.detectMarkers(image, self._aruco_dict, parameters=self._get_params(image, 1))
+            if len(corners) == 0:
+                return []
+        offset = numpy.array([x, y], dtype=numpy.float32)
+        if self._tag_ids is not None:
+            ids = self._tag_ids[ids]
+        return [FiducialImageObservation(id[0], corner + offset) for id, corner in zip(ids, corners)]
+
+    def _get_tracked_regions(self, tracks: Dict[int, Tuple[numpy.typing.NDArray[numpy.float32], numpy.typing.NDArray[numpy.float32]]], image_width: int, image_height: int) -> List[List[int]]:
+        """Padded boxes [x0, y0, x1, y1] around each tag's last and predicted positions, with overlaps merged."""
+        regions = []
+        for corners, predicted_corners in tracks.values():
+            points = numpy.concatenate([corners[0], predicted_corners[0]])
+            x0, y0 = points.min(axis=0)
+            x1, y1 = points.max(axis=0)
+            padding = max(max(x1 - x0, y1 - y0) * self.ROI_PADDING, self.ROI_MIN_PADDING_PX)
+            regions.append([max(0, int(x0 - padding)), max(0, int(y0 - padding)),
+                            min(image_width, int(x1 + padding) + 1), min(image_height, int(y1 + padding) + 1)])
+
+        merged = True
+        while merged:
+            merged = False
+            for i in range(len(regions)):
+                for j in range(i + 1, len(regions)):
+                    a, b = regions[i], regions[j]
+                    if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                        regions[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                        del regions[j]
+                        merged = True
+                        break
+                if merged:
+                    break
+        return regions
+
+    def _detect_tracked(self, image: cv2.Mat, tracks: Dict[int, Tuple[numpy.typing.NDArray[numpy.float32], numpy.typing.NDArray[numpy.float32]]], decimation: int) -> Union[List[FiducialImageObservation], None]:
+        """Detect only around tracked tags. Returns None if any tracked tag was lost."""
+        observations: Dict[int, FiducialImageObservation] = {}
+        for x0, y0, x1, y1 in self._get_tracked_regions(tracks, image.shape[1], image.shape[0]):
+            for observation in self._detect_region(image[y0:y1, x0:x1], x0, y0, decimation):
+                observations[observation.tag_id] = observation
+        if any(tag_id not in observations for tag_id in tracks):
+            return None
+        return list(observations.values())
+
+    def _is_duplicate(self, observation_a: FiducialImageObservation, observation_b: FiducialImageObservation) -> bool:
+        if observation_a.tag_id != observation_b.tag_id:
+            return False
+        corners_a = observation_a.corners[0]
+        size = numpy.linalg.norm(corners_a - numpy.roll(corners_a, 1, axis=0), axis=1).mean()
+        distance = numpy.linalg.norm(corners_a - observation_b.corners[0], axis=1).mean()
+        return distance < size * self.DUPLICATE_DISTANCE
+
+    def _detect_tiled(self, image: cv2.Mat, rows: int, cols: int, overlap: int, decimation: int) -> List[FiducialImageObservation]:
+        """Detect in overlapping tiles on a thread pool, merging tags seen by more than one tile.
+
+        The overlap should be at least the largest expected tag size in pixels, so every tag lies
+        completely inside some tile.
+        """
+        height, width = image.shape[0], image.shape[1]
+        regions = []
+        for row in range(rows):
+            for col in range(cols):
+                regions.append([max(0, col * width // cols - overlap // 2), max(0, row * height // rows - overlap // 2),
+                                min(width, (col + 1) * width // cols + overlap // 2), min(height, (row + 1) * height // rows + overlap // 2)])
+
+        if self._executor == None or self._executor_size != len(regions):
+            if self._executor != None:
+                self._executor.shutdown(wait=False)
+            self._executor = ThreadPoolExecutor(max_workers=len(regions))
+            self._executor_size = len(regions)
+
+        futures = [self._executor.submit(self._detect_region, image[y0:y1, x0:x1], x0, y0, decimation)
+                   for x0, y0, x1, y1 in regions]
+        observations: List[FiducialImageObservation] = []
+        for future in futures:
+            for observation in future.result():
+                if not any(self._is_duplicate(observation, other) for other in observations):
+                    observations.append(observation)
+        return observations
+
+
+class AprilTagFiducialDetector(FiducialDetector):
+    """Detects tags with the native AprilTag 3 library through pupil_apriltags."""
+
+    # AprilTag lists corners as top right, top left, bottom left, bottom right. ArUco (and the pose
+    # estimators) use top left, top right, bottom right, bottom left.
+    CORNER_ORDER = [1, 0, 3, 2]
+
+    def __init__(self, family: str, extra_tag_ids: Union[List[int], None] = None) -> None:
+        """With "extra_tag_ids", only the tags in the active field layout plus these are reported."""
+        if pupil_apriltags == None:
+            raise RuntimeError("The AprilTag backend requires the pupil_apriltags package")
+        self._family = family
+        self._extra_tag_ids = extra_tag_ids
+        self._detector = None
+        self._detector_settings = None
+
+    def detect_fiducials(self, image: cv2.Mat, config_store: ConfigStore, sequence: Union[int, None] = None) -> List[FiducialImageObservation]:
+        # Detector settings are fixed at creation, so recreate it when they change
+        settings = (config_store.remote_config.apriltag_nthreads, config_store.remote_config.apriltag_quad_decimate,
+                    config_store.remote_config.apriltag_quad_sigma, config_store.remote_config.apriltag_refine_edges)
+        if self._detector == None or settings != self._detector_settings:
+            self._detector = pupil_apriltags.Detector(families=self._family, nthreads=settings[0], quad_decimate=settings[1],
+                                                      quad_sigma=settings[2], refine_edges=1 if settings[3] else 0)
+            self._detector_settings = settings
+
+        if len(image.shape) == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        detections = self._detector.detect(image)
+        if self._extra_tag_ids != None:
+            # The native detector cannot be restricted to a subset of the family, so filter afterwards
+            tag_ids = set(get_tag_ids(get_tag_layout(config_store)) + self._extra_tag_ids)
+            detections = [x for x in detections if x.tag_id in tag_ids]
+        return [FiducialImageObservation(detection.tag_id, detection.corners[self.CORNER_ORDER].reshape(1, 4, 2).astype(numpy.float32))
+                for detection in detections]
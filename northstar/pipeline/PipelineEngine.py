@@ -0,0 +1,143 @@
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Callable, Deque, Dict, List, Set, Tuple, Union
+
+import cv2
+
+
+@dataclass
+class PipelineFrame:
+    """A captured frame travelling through the pipeline, tagged with its capture order."""
+
+    sequence: int
+    timestamp: float
+    image: cv2.Mat
+    result: Any = None
+
+
+class LatestFrameQueue:
+    """Bounded queue where the newest frame always wins. When full, the oldest frame is dropped."""
+
+    def __init__(self, capacity: int) -> None:
+        self._capacity = max(1, capacity)
+        self._frames: Deque[PipelineFrame] = deque()
+        self._condition = threading.Condition()
+        self.dropped_count = 0
+
+    def put(self, frame: PipelineFrame) -> None:
+        with self._condition:
+            if len(self._frames) >= self._capacity:
+                self._frames.popleft()
+                self.dropped_count += 1
+            self._frames.append(frame)
+            self._condition.notify()
+
+    def get(self, on_take: Union[Callable[[PipelineFrame], None], None] = None) -> PipelineFrame:
+        """Wait for the oldest queued frame. "on_take" runs while the queue is still locked."""
+        with self._condition:
+            while len(self._frames) == 0:
+                self._condition.wait()
+            frame = self._frames.popleft()
+            if on_take != None:
+                on_take(frame)
+            return frame
+
+
+class _OrderedOutput:
+    """Releases processed frames in capture order, skipping frames that were dropped before processing."""
+
+    def __init__(self, max_in_flight: int) -> None:
+        self._max_in_flight = max(1, max_in_flight)
+        self._condition = threading.Condition()
+        self._pending: Set[int] = set()
+        self._done: Dict[int, PipelineFrame] = {}
+
+    def wait_for_room(self) -> None:
+        with self._condition:
+            while len(self._pending) >= self._max_in_flight:
+                self._condition.wait()
+
+    def claim(self, frame: PipelineFrame) -> None:
+        with self._condition:
+            self._pending.add(frame.sequence)
+
+    def complete(self, frame: PipelineFrame) -> None:
+        with self._condition:
+            self._done[frame.sequence] = frame
+            self._condition.notify_all()
+
+    def next(self) -> PipelineFrame:
+        with self._condition:
+            while True:
+                if len(self._pending) > 0:
+                    oldest = min(self._pending)
+                    if oldest in self._done:
+                        self._pending.remove(oldest)
+                        self._condition.notify_all()
+                        return self._done.pop(oldest)
+                self._condition.wait()
+
+
+class PipelineEngine:
+    """Runs capture, processing and publishing as concurrent stages.
+
+    Capture runs on the calling thread and feeds a latest-frame-wins queue. The capture function
+    returns the frame sequence number (strictly increasing), capture timestamp and image. Each
+    worker thread owns the processing function built by "worker_factory", so stateful detectors
+    and estimators are never shared between threads. OpenCV releases the GIL inside detection and solvePnP, so the
+    workers overlap. The publish stage receives frames strictly in capture order with their
+    original timestamps.
+    """
+
+    def __init__(self,
+                 capture: Callable[[], Union[Tuple[int, float, cv2.Mat], None]],
+                 worker_factory: Callable[[], Callable[[PipelineFrame], Any]],
+                 publish: Callable[[PipelineFrame], None],
+                 workers: int) -> None:
+        self._capture = capture
+        self._worker_factory = worker_factory
+        self._publish = publish
+        self._worker_count = max(1, workers)
+        self._queue = LatestFrameQueue(self._worker_count)
+        self._output = _OrderedOutput(self._worker_count * 2)
+        self._error: Union[BaseException, None] = None
+        self._threads: List[threading.Thread] = []
+
+    def get_dropped_count(self) -> int:
+        return self._queue.dropped_count
+
+    def _run_worker(self) -> None:
+        try:
+            process = self._worker_factory()
+            while True:
+                self._output.wait_for_room()
+                frame = self._queue.get(self._output.claim)
+                frame.result = process(frame)
+                self._output.complete(frame)
+        except BaseException as e:
+            self._error = e
+
+    def _run_publisher(self) -> None:
+        try:
+            while True:
+                self._publish(self._output.next())
+        except BaseException as e:
+            self._error = e
+
+    def run(self) -> None:
+        """Start the worker and publish threads, then run the capture stage on this thread forever."""
+        for _ in range(self._worker_count):
+            self._threads.append(threading.Thread(target=self._run_worker, daemon=True))
+        self._threads.append(threading.Thread(target=self._run_publisher, daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+        while True:
+            if self._error != None:
+                raise self._error
+            captured = self._capture()
+            if captured == None:
+                continue
+            sequence, timestamp, image = captured
+            self._queue.put(PipelineFrame(sequence, timestamp, image))
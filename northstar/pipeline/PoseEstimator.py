@@ -1,11 +1,14 @@
-from typing import Union
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Union
 
 import cv2
 import numpy
+import numpy.typing
 from config.config import ConfigStore
 from vision_types import FiducialImageObservation, FiducialPoseObservation
 
-from pipeline.coordinate_systems import openCvPoseToWpilib
+from pipeline import ippe, se3
+from pipeline.undistortion import get_distortion_coefficients
 
 
 class PoseEstimator:
@@ -15,27 +18,74 @@ class PoseEstimator:
     def solve_fiducial_pose(self, image_observation: FiducialImageObservation, config_store: ConfigStore) -> Union[FiducialPoseObservation, None]:
         raise NotImplementedError
 
+    def solve_fiducial_poses(self, image_observations: List[FiducialImageObservation], config_store: ConfigStore) -> List[FiducialPoseObservation]:
+        """Solve every observation, leaving out those that fail."""
+        raise NotImplementedError
+
 
 class SquareTargetPoseEstimator(PoseEstimator):
+    BATCH_MIN_TAGS = 20  # Fewest tags solved with the batched solver, below which per-tag OpenCV calls are cheaper
+    POOL_MIN_TAGS_PER_THREAD = BATCH_MIN_TAGS  # Each thread gets a batch, next to which its ~35 us dispatch cost is small
+
     def __init__(self) -> None:
-        pass
+        self._object_points = numpy.zeros((0, 3))
+        self._object_points_size: Union[float, None] = None
+        self._executor: Union[ThreadPoolExecutor, None] = None
+        self._executor_size = 0
+
+    def _get_object_points(self, fid_size: float) -> numpy.typing.NDArray[numpy.float64]:
+        """Tag corners shared by every solve, rebuilt only when the fiducial size changes."""
+        if fid_size != self._object_points_size:
+            self._object_points = ippe.get_square_object_points(fid_size)
+            self._object_points_size = fid_size
+        return self._object_points
 
     def solve_fiducial_pose(self, image_observation: FiducialImageObservation, config_store: ConfigStore) -> Union[FiducialPoseObservation, None]:
-        fid_size = config_store.remote_config.fiducial_size_m
-        object_points = numpy.array([[-fid_size / 2.0, fid_size / 2.0, 0.0],
-                                     [fid_size / 2.0, fid_size / 2.0, 0.0],
-                                     [fid_size / 2.0, -fid_size / 2.0, 0.0],
-                                     [-fid_size / 2.0, -fid_size / 2.0, 0.0]])
-
-        try:
-            _, rvecs, tvecs, errors = cv2.solvePnPGeneric(object_points, image_observation.corners, config_store.local_config.camera_matrix,
-                                                          config_store.local_config.distortion_coefficients, flags=cv2.SOLVEPNP_IPPE_SQUARE)
-        except:
-            return None
-        return FiducialPoseObservation(
-            image_observation.tag_id,
-            openCvPoseToWpilib(tvecs[0], rvecs[0]),
-            errors[0][0],
-            openCvPoseToWpilib(tvecs[1], rvecs[1]),
-            errors[1][0]
-        )
+        pose_observations = self.solve_fiducial_poses([image_observation], config_store)
+        return pose_observations[0] if len(pose_observations) > 0 else None
+
+    def solve_fiducial_poses(self, image_observations: List[FiducialImageObservation], config_store: ConfigStore) -> List[FiducialPoseObservation]:
+        object_points = self._get_object_points(config_store.remote_config.fiducial_size_m)
+        camera_matrix = config_store.local_config.camera_matrix
+        distortion_coefficients = get_distortion_coefficients(image_observations, config_store)
+
+        # Large frames can be split across a small pool, since NumPy and OpenCV release the GIL
+        threads = min(config_store.remote_config.solver_tag_threads, len(image_observations) // self.POOL_MIN_TAGS_PER_THREAD)
+        if threads <= 1:
+            return self._solve_tags(image_observations, object_points, camera_matrix, distortion_coefficients)
+        if self._executor == None or self._executor_size != threads:
+            if self._executor != None:
+                self._executor.shutdown(wait=False)
+            self._executor = ThreadPoolExecutor(max_workers=threads)
+            self._executor_size = threads
+        chunk_size = -(-len(image_observations) // threads)
+        chunks = [image_observations[i:i + chunk_size] for i in range(0, len(image_observations), chunk_size)]
+        return [x for chunk in self._executor.map(lambda x: self._solve_tags(x, object_points, camera_matrix, distortion_coefficients), chunks)
+                for x in chunk]
+
+    def _solve_tags(self, image_observations: List[FiducialImageObservation], object_points: numpy.typing.NDArray[numpy.float64],
+                    camera_matrix: numpy.typing.NDArray[numpy.float64], distortion_coefficients: numpy.typing.NDArray[numpy.float64]) -> List[FiducialPoseObservation]:
+        if len(image_observations) < self.BATCH_MIN_TAGS:
+            pose_observations = []
+            for observation in image_observations:
+                try:
+                    _, rvecs, tvecs, errors = cv2.solvePnPGeneric(object_points, observation.corners, camera_matrix, distortion_coefficients,
+                                                                  flags=cv2.SOLVEPNP_IPPE_SQUARE)
+                except:
+                    continue
+                pose_observations.append(FiducialPoseObservation(
+                    observation.tag_id,
+                    se3.opencv_to_pose3d(rvecs[0], tvecs[0]),
+                    errors[0][0],
+                    se3.opencv_to_pose3d(rvecs[1], tvecs[1]),
+                    errors[1][0]
+                ))
+            return pose_observations
+
+        # Batched solve, with all poses converted together
+        corners = numpy.array([x.corners.reshape(4, 2) for x in image_observations])
+        transforms, errors, valid = ippe.solve_square(corners, object_points, camera_matrix, distortion_coefficients)
+        poses = se3.to_pose3ds(se3.opencv_to_wpilib(transforms[valid]).reshape(-1, 4, 4))
+        errors = errors[valid].tolist()
+        return [FiducialPoseObservation(observation.tag_id, poses[2 * i], errors[i][0], poses[2 * i + 1], errors[i][1])
+                for i, observation in enumerate([x for x, solved in zip(image_observations, valid) if solved])]
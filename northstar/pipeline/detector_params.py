@@ -0,0 +1,28 @@
+import json
+import os
+from typing import Dict, Union
+
+import cv2
+
+DETECTOR_PARAMS_FILENAME = "detector_params.json"
+
+
+def make_detector_params(values: Dict[str, Union[int, float]]) -> cv2.aruco.DetectorParameters:
+    """Create ArUco detector parameters, overriding the OpenCV defaults with "values"."""
+    params = cv2.aruco.DetectorParameters_create()
+    for name, value in values.items():
+        setattr(params, name, value)
+    return params
+
+
+def load_detector_param_values(filename: str = DETECTOR_PARAMS_FILENAME) -> Dict[str, Union[int, float]]:
+    """Load the parameter overrides written by tune_detector.py, or none if the file does not exist."""
+    if not os.path.exists(filename):
+        return {}
+    with open(filename, "r") as params_file:
+        return json.loads(params_file.read())
+
+
+def save_detector_params(values: Dict[str, Union[int, float]], filename: str = DETECTOR_PARAMS_FILENAME) -> None:
+    with open(filename, "w") as params_file:
+        params_file.write(json.dumps(values, indent=2))
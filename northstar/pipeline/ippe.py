@@ -0,0 +1,110 @@
+from typing import Tuple
+
+import cv2
+import numpy
+import numpy.typing
+
+from pipeline import se3
+
+# Batched IPPE (infinitesimal plane-based pose estimation, Collins and Bartoli 2014) for square tags,
+# following OpenCV's SOLVEPNP_IPPE_SQUARE: corners are undistorted and the homography from the tag
+# plane is decomposed into its two candidate rotations, each with a least squares translation. Every
+# step runs on all tags at once, so the cost of a frame grows slowly with the number of tags.
+
+# Signs taking the decomposition of the first rotation to both rotations, the second mirroring the
+# tag's normal
+_SOLUTION_SIGNS = numpy.array([numpy.ones((3, 3)), [[1.0, 1.0, -1.0], [1.0, 1.0, -1.0], [-1.0, -1.0, 1.0]]])
+
+
+def get_square_object_points(fid_size: float) -> numpy.typing.NDArray[numpy.float64]:
+    """Tag corners in the tag frame (OpenCV axes), in detection order."""
+    return numpy.array([[-fid_size / 2.0, fid_size / 2.0, 0.0],
+                        [fid_size / 2.0, fid_size / 2.0, 0.0],
+                        [fid_size / 2.0, -fid_size / 2.0, 0.0],
+                        [-fid_size / 2.0, -fid_size / 2.0, 0.0]])
+
+
+def solve_square(corners: numpy.typing.NDArray[numpy.float32], object_points: numpy.typing.NDArray[numpy.float64],
+                 camera_matrix: numpy.typing.NDArray[numpy.float64], distortion_coefficients: numpy.typing.NDArray[numpy.float64]) -> Tuple[numpy.typing.NDArray[numpy.float64], numpy.typing.NDArray[numpy.float64], numpy.typing.NDArray[numpy.bool_]]:
+    """Solve the camera to tag pose of N square tags from their corners (N, 4, 2), with the tag's
+    corners from get_square_object_points.
+
+    Returns both candidate transforms per tag (N, 2, 4, 4) in OpenCV axes, their RMS reprojection
+    errors in pixels (N, 2), sorted so the first solution has the lower error, and which tags could
+    be solved (N). Small NumPy calls cost more than the math here, so the solve is written in closed
+    form over arrays with one entry per tag rather than with batched linear algebra.
+    """
+    count = len(corners)
+    fid_size = object_points[1, 0] - object_points[0, 0]
+    corners = corners.reshape(count, 4, 2).astype(numpy.float64)
+    points = cv2.undistortPoints(corners.reshape(-1, 1, 2), camera_matrix, distortion_coefficients).reshape(count, 4, 2)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        # Homography from the unit square to the normalized image (Heckbert's square to quad mapping),
+        # with each corner as a (2, N) array of x and y
+        point_0, point_1, point_2, point_3 = points.transpose(1, 2, 0)
+        delta_1, delta_2, delta_3 = point_1 - point_2, point_3 - point_2, point_0 - point_1 + point_2 - point_3
+        determinant = delta_1[0] * delta_2[1] - delta_2[0] * delta_1[1]
+        g = (delta_3[0] * delta_2[1] - delta_2[0] * delta_3[1]) / determinant
+        h = (delta_1[0] * delta_3[1] - delta_3[0] * delta_1[1]) / determinant
+        column_s = point_1 - point_0 + g * point_1
+        column_t = point_3 - point_0 + h * point_3
+
+        # Image of the tag center and the homography's Jacobian there, in tag plane units
+        w = 0.5 * (g + h) + 1
+        center = (0.5 * (column_s + column_t) + point_0) / w
+        j00, j10 = (column_s - g * center) / (w * fid_size)
+        j01, j11 = (h * center - column_t) / (w * fid_size)
+        center_x, center_y = center
+
+        # Rotation taking the optical axis to the ray through the tag center
+        ray_norms = numpy.sqrt(1 + center_x * center_x + center_y * center_y)
+        ray_a, ray_b, ray_c = -center_y / ray_norms, center_x / ray_norms, 1 / ray_norms
+        ray_k = 1 / (1 + ray_c)
+        ray_ab = ray_k * ray_a * ray_b
+        ray_rotations = numpy.stack([1 - ray_k * ray_b * ray_b, ray_ab, ray_b,
+                                     ray_ab, 1 - ray_k * ray_a * ray_a, -ray_a,
+                                     -ray_b, ray_a, ray_c], axis=-1).reshape(count, 3, 3)
+
+        # Decompose the Jacobian into the two rotations that explain it, as in OpenCV's IPPE
+        b00, b01 = 1 - ray_k * ray_b * ray_b + center_x * ray_b, ray_ab - center_x * ray_a
+        b10, b11 = ray_ab + center_y * ray_b, 1 - ray_k * ray_a * ray_a - center_y * ray_a
+        b_determinant = b00 * b11 - b01 * b10
+        a00, a01 = (b11 * j00 - b01 * j10) / b_determinant, (b11 * j01 - b01 * j11) / b_determinant
+        a10, a11 = (b00 * j10 - b10 * j00) / b_determinant, (b00 * j11 - b10 * j01) / b_determinant
+        ata00, ata01, ata11 = a00 * a00 + a01 * a01, a00 * a10 + a01 * a11, a10 * a10 + a11 * a11
+        gamma = numpy.sqrt(0.5 * (ata00 + ata11 + numpy.sqrt((ata00 - ata11) ** 2 + 4 * ata01 * ata01)))
+        r00, r01, r10, r11 = a00 / gamma, a01 / gamma, a10 / gamma, a11 / gamma
+        b0 = numpy.sqrt(numpy.maximum(0.0, 1 - r00 * r00 - r10 * r10))
+        b1 = numpy.sqrt(numpy.maximum(0.0, 1 - r01 * r01 - r11 * r11))
+        b1 = numpy.where(r00 * r01 + r10 * r11 > 0, -b1, b1)
+        decomposition = numpy.stack([r00, r01, b1 * r10 - b0 * r11,
+                                     r10, r11, b0 * r01 - b1 * r00,
+                                     b0, b1, r00 * r11 - r01 * r10], axis=-1).reshape(count, 1, 3, 3)
+        rotations = ray_rotations[:, None] @ (decomposition * _SOLUTION_SIGNS)
+
+        # Least squares translation of each rotation, from u * (Z + tz) = X + tx and v * (Z + tz) = Y + ty,
+        # with the 3x3 normal equations solved in closed form
+        rotated_points = object_points @ rotations.transpose(0, 1, 3, 2)
+        u, v = points[:, None, :, 0], points[:, None, :, 1]
+        residual_x = u * rotated_points[..., 2] - rotated_points[..., 0]
+        residual_y = v * rotated_points[..., 2] - rotated_points[..., 1]
+        sum_x, sum_y = residual_x.sum(-1), residual_y.sum(-1)
+        sum_u, sum_v = u.sum(-1), v.sum(-1)
+        tz = (0.25 * (sum_u * sum_x + sum_v * sum_y) - (u * residual_x + v * residual_y).sum(-1)) / \
+            ((u * u + v * v).sum(-1) - 0.25 * (sum_u * sum_u + sum_v * sum_v))
+        translations = numpy.stack([0.25 * (sum_x + sum_u * tz), 0.25 * (sum_y + sum_v * tz), tz], axis=-1)
+
+    # RMS reprojection errors through the full camera model, in one call for every candidate
+    camera_points = rotated_points + translations[:, :, None, :]
+    valid = numpy.isfinite(camera_points.reshape(count, -1).sum(-1))
+    if not valid.all():
+        camera_points[~valid] = 1.0
+    projected_points, _ = cv2.projectPoints(camera_points.reshape(-1, 3), numpy.zeros(3), numpy.zeros(3), camera_matrix, distortion_coefficients)
+    residuals = (projected_points.reshape(count, 2, 8) - corners.reshape(count, 1, 8))
+    errors = numpy.sqrt((residuals * residuals).sum(-1) / 8)
+
+    transforms = se3.make_transforms(rotations, translations)
+    swap = errors[:, 0] > errors[:, 1]
+    transforms[swap] = transforms[swap][:, ::-1]
+    errors[swap] = errors[swap][:, ::-1]
+    return transforms, errors, valid
@@ -0,0 +1,16 @@
+import os
+from typing import List
+
+import cv2
+
+
+def load_recorded_frames(directory: str) -> List[cv2.Mat]:
+    """Load the frames in a directory as grayscale images in filename order, skipping unreadable files."""
+    images = []
+    for filename in sorted([x for x in os.listdir(directory) if not x.startswith(".")]):
+        image = cv2.imread(os.path.join(directory, filename), cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            print("Skipping unreadable frame " + filename)
+            continue
+        images.append(image)
+    return images
@@ -0,0 +1,175 @@
+import math
+from typing import List
+
+import numpy
+import numpy.typing
+from wpimath.geometry import *
+
+# Batched rigid transforms as arrays of 4x4 homogeneous matrices, shape (..., 4, 4). Rotation vectors
+# and translations are (..., 3) and quaternions are (..., 4) in (w, x, y, z) order. Poses are only
+# converted to WPILib objects at the output boundary.
+
+# Change of basis from OpenCV camera axes (x right, y down, z forward) to WPILib axes (x forward,
+# y left, z up)
+OPENCV_TO_WPILIB = numpy.array([[0.0, 0.0, 1.0, 0.0],
+                                [-1.0, 0.0, 0.0, 0.0],
+                                [0.0, -1.0, 0.0, 0.0],
+                                [0.0, 0.0, 0.0, 1.0]])
+WPILIB_TO_OPENCV = OPENCV_TO_WPILIB.T
+
+_EPSILON = 1e-12
+
+
+def _linear_map(rows, size: int) -> numpy.typing.NDArray[numpy.float64]:
+    """Matrix whose columns are the given linear combinations ({input index: coefficient}) of "size" inputs."""
+    matrix = numpy.zeros((size, len(rows)))
+    for column, row in enumerate(rows):
+        for index, coefficient in row.items():
+            matrix[index, column] = coefficient
+    return matrix
+
+
+# Conversions are written as products with these constant matrices, so each one is a handful of
+# array operations regardless of the batch size
+
+# Skew-symmetric cross product matrix of a vector, as (3) @ (3, 9)
+_SKEW = _linear_map([{}, {2: -1}, {1: 1}, {2: 1}, {}, {0: -1}, {1: -1}, {0: 1}, {}], 3)
+
+# Rotation matrix (times the squared norm) from the outer product of a quaternion with itself, as
+# (16) @ (16, 9). Entry 4 * i + j of the outer product is q[i] * q[j] with q = (w, x, y, z).
+_QUATERNION_TO_MATRIX = _linear_map([
+    {0: 1, 5: 1, 10: -1, 15: -1}, {6: 2, 3: -2}, {7: 2, 2: 2},
+    {6: 2, 3: 2}, {0: 1, 5: -1, 10: 1, 15: -1}, {11: 2, 1: -2},
+    {7: 2, 2: -2}, {11: 2, 1: 2}, {0: 1, 5: -1, 10: -1, 15: 1}
+], 16)
+
+# Four unnormalized quaternion candidates (Shepperd's method) from a flattened rotation matrix, as
+# (9) @ (9, 16) + (16). Candidate i is best conditioned when its component i is the largest.
+_MATRIX_TO_QUATERNIONS = _linear_map([
+    {0: 1, 4: 1, 8: 1}, {7: 1, 5: -1}, {2: 1, 6: -1}, {3: 1, 1: -1},
+    {7: 1, 5: -1}, {0: 1, 4: -1, 8: -1}, {1: 1, 3: 1}, {2: 1, 6: 1},
+    {2: 1, 6: -1}, {1: 1, 3: 1}, {0: -1, 4: 1, 8: -1}, {5: 1, 7: 1},
+    {3: 1, 1: -1}, {2: 1, 6: 1}, {5: 1, 7: 1}, {0: -1, 4: -1, 8: 1}
+], 9)
+_MATRIX_TO_QUATERNIONS_OFFSET = numpy.eye(4).reshape(16)
+
+
+def rodrigues_to_matrix(rvecs: numpy.typing.NDArray[numpy.float64]) -> numpy.typing.NDArray[numpy.float64]:
+    angles = numpy.sqrt(numpy.sum(rvecs * rvecs, axis=-1))[..., None, None]
+    axes = rvecs / numpy.maximum(angles[..., 0], _EPSILON)
+    skew = (axes @ _SKEW).reshape(axes.shape[:-1] + (3, 3))
+    outer = axes[..., :, None] * axes[..., None, :]
+    cos = numpy.cos(angles)
+    return cos * numpy.eye(3) + (1 - cos) * outer + numpy.sin(angles) * skew
+
+
+def matrix_to_rodrigues(rotations: numpy.typing.NDArray[numpy.float64]) -> numpy.typing.NDArray[numpy.float64]:
+    quaternions = matrix_to_quaternion(rotations)
+    vector_norms = numpy.linalg.norm(quaternions[..., 1:], axis=-1)
+    angles = 2 * numpy.arctan2(vector_norms, quaternions[..., 0])
+    return quaternions[..., 1:] * (angles / numpy.maximum(vector_norms, _EPSILON))[..., None]
+
+
+def quaternion_to_matrix(quaternions: numpy.typing.NDArray[numpy.float64]) -> numpy.typing.NDArray[numpy.float64]:
+    """Convert quaternions to rotation matrices. The quaternions do not need to be normalized."""
+    outer = (quaternions[..., :, None] * quaternions[..., None, :]).reshape(quaternions.shape[:-1] + (16,))
+    norms = numpy.sum(quaternions * quaternions, axis=-1)[..., None]
+    return (outer @ _QUATERNION_TO_MATRIX / norms).reshape(quaternions.shape[:-1] + (3, 3))
+
+
+def matrix_to_quaternion(rotations: numpy.typing.NDArray[numpy.float64]) -> numpy.typing.NDArray[numpy.float64]:
+    """Convert rotation matrices to unit quaternions with w >= 0."""
+    candidates = (rotations.reshape(-1, 9) @ _MATRIX_TO_QUATERNIONS + _MATRIX_TO_QUATERNIONS_OFFSET).reshape(-1, 4, 4)
+    best = numpy.argmax(candidates.diagonal(axis1=-2, axis2=-1), axis=-1)
+    quaternions = candidates[numpy.arange(len(best)), best]
+    quaternions *= numpy.copysign(1.0, quaternions[:, :1]) / numpy.sqrt(numpy.sum(quaternions * quaternions, axis=-1))[:, None]
+    return quaternions.reshape(rotations.shape[:-2] + (4,))
+
+
+def make_transforms(rotations: numpy.typing.NDArray[numpy.float64], translations: numpy.typing.NDArray[numpy.float64]) -> numpy.typing.NDArray[numpy.float64]:
+    transforms = numpy.zeros(rotations.shape[:-2] + (4, 4))
+    transforms[..., :3, :3] = rotations
+    transforms[..., :3, 3] = translations
+    transforms[..., 3, 3] = 1.0
+    return transforms
+
+
+def from_opencv(rvecs: numpy.typing.NDArray[numpy.float64], tvecs: numpy.typing.NDArray[numpy.float64]) -> numpy.typing.NDArray[numpy.float64]:
+    """Transforms from solvePnP rotation and translation vectors of shape (..., 3) or (..., 3, 1)."""
+    rvecs = numpy.asarray(rvecs, dtype=numpy.float64)
+    tvecs = numpy.asarray(tvecs, dtype=numpy.float64)
+    if rvecs.shape[-1] == 1:
+        rvecs = rvecs[..., 0]
+        tvecs = tvecs[..., 0]
+    return make_transforms(rodrigues_to_matrix(rvecs), tvecs)
+
+
+def compose(transforms_a: numpy.typing.NDArray[numpy.float64], transforms_b: numpy.typing.NDArray[numpy.float64]) -> numpy.typing.NDArray[numpy.float64]:
+    """Apply b in the frame of a, like Pose3d.transformBy."""
+    return transforms_a @ transforms_b
+
+
+def invert(transforms: numpy.typing.NDArray[numpy.float64]) -> numpy.typing.NDArray[numpy.float64]:
+    rotations = numpy.swapaxes(transforms[..., :3, :3], -1, -2)
+    return make_transforms(rotations, -(rotations @ transforms[..., :3, 3:])[..., 0])
+
+
+def transform_points(transforms: numpy.typing.NDArray[numpy.float64], points: numpy.typing.NDArray[numpy.float64]) -> numpy.typing.NDArray[numpy.float64]:
+    """Apply each transform (..., 4, 4) to every point (M, 3), giving (..., M, 3)."""
+    return points @ numpy.swapaxes(transforms[..., :3, :3], -1, -2) + transforms[..., None, :3, 3]
+
+
+def opencv_to_wpilib(transforms: numpy.typing.NDArray[numpy.float64]) -> numpy.typing.NDArray[numpy.float64]:
+    return OPENCV_TO_WPILIB @ transforms @ WPILIB_TO_OPENCV
+
+
+def wpilib_to_opencv(transforms: numpy.typing.NDArray[numpy.float64]) -> numpy.typing.NDArray[numpy.float64]:
+    return WPILIB_TO_OPENCV @ transforms @ OPENCV_TO_WPILIB
+
+
+def to_pose3ds(transforms: numpy.typing.NDArray[numpy.float64]) -> List[Pose3d]:
+    """Convert a batch of transforms (N, 4, 4) to WPILib poses.
+
+    Poses are created one at a time anyway, so the rotations are converted with scalar math, which
+    is cheaper than array operations for the few poses per frame.
+    """
+    poses = []
+    for row_0, row_1, row_2, _ in transforms.tolist():
+        r00, r01, r02, x = row_0
+        r10, r11, r12, y = row_1
+        r20, r21, r22, z = row_2
+        # Solve from the largest quaternion component for numerical stability (Shepperd's method)
+        trace = r00 + r11 + r22
+        if trace >= r00 and trace >= r11 and trace >= r22:
+            quaternion = (1 + trace, r21 - r12, r02 - r20, r10 - r01)
+        elif r00 >= r11 and r00 >= r22:
+            quaternion = (r21 - r12, 1 + r00 - r11 - r22, r01 + r10, r02 + r20)
+        elif r11 >= r22:
+            quaternion = (r02 - r20, r01 + r10, 1 - r00 + r11 - r22, r12 + r21)
+        else:
+            quaternion = (r10 - r01, r02 + r20, r12 + r21, 1 - r00 - r11 + r22)
+        poses.append(Pose3d(Translation3d(x, y, z), Rotation3d(Quaternion(*quaternion).normalize())))
+    return poses
+
+
+def to_pose3d(transform: numpy.typing.NDArray[numpy.float64]) -> Pose3d:
+    return to_pose3ds(transform[None])[0]
+
+
+def opencv_to_pose3d(rvec: numpy.typing.NDArray[numpy.float64], tvec: numpy.typing.NDArray[numpy.float64]) -> Pose3d:
+    """Convert a single solvePnP solution to a WPILib pose with scalar math.
+
+    The array functions above cost tens of microseconds however few poses they are given, so paths
+    with one or two poses per frame convert with this and chain with WPILib's own transforms.
+    """
+    rx, ry, rz = numpy.ravel(rvec).tolist()
+    x, y, z = numpy.ravel(tvec).tolist()
+    angle = math.sqrt(rx * rx + ry * ry + rz * rz)
+    scale = math.sin(angle / 2) / angle if angle > _EPSILON else 0.5
+    return Pose3d(Translation3d(z, -x, -y), Rotation3d(Quaternion(math.cos(angle / 2), rz * scale, -rx * scale, -ry * scale)))
+
+
+def from_pose3d(pose: Pose3d) -> numpy.typing.NDArray[numpy.float64]:
+    quaternion = pose.rotation().getQuaternion()
+    return make_transforms(quaternion_to_matrix(numpy.array([quaternion.W(), quaternion.X(), quaternion.Y(), quaternion.Z()])),
+                           numpy.array([pose.X(), pose.Y(), pose.Z()]))
@@ -0,0 +1,108 @@
+import hashlib
+import json
+import os
+import threading
+from typing import Any, Dict, List, Tuple, Union
+
+import numpy
+import numpy.typing
+from config.config import ConfigStore
+from wpimath.geometry import *
+
+from pipeline import se3
+
+_layout_cache: Dict[str, Tuple[float, Any]] = {}
+_layout_cache_lock = threading.Lock()
+_pushed_layouts: Dict[str, Any] = {}  # By SHA-256 of the pushed JSON
+_index_cache: Union["TagLayoutIndex", None] = None
+
+
+def load_tag_layout(filename: str) -> Any:
+    """Load a field layout JSON file, shared between callers and re-read only when the file changes."""
+    modified_time = os.path.getmtime(filename)
+    with _layout_cache_lock:
+        if filename not in _layout_cache or _layout_cache[filename][0] != modified_time:
+            with open(filename, "r") as layout_file:
+                _layout_cache[filename] = (modified_time, json.loads(layout_file.read()))
+        return _layout_cache[filename][1]
+
+
+def parse_pushed_tag_layout(layout_json: str, fid_size: float) -> Union[Any, None]:
+    """Parse a layout pushed as JSON, once per distinct content. Returns None if it is not a layout.
+
+    A layout is only accepted once its index builds. That index is the shared one for "fid_size",
+    so the estimators start using the layout without building it again.
+    """
+    digest = hashlib.sha256(layout_json.encode()).hexdigest()
+    with _layout_cache_lock:
+        if digest in _pushed_layouts:
+            return _pushed_layouts[digest]
+    try:
+        tag_layout = json.loads(layout_json)
+        if not all([type(x) == int for x in get_tag_ids(tag_layout)]):
+            return None
+        get_tag_layout_index(tag_layout, fid_size)
+    except:
+        return None
+
+    with _layout_cache_lock:
+        _pushed_layouts[digest] = tag_layout
+    print("Loaded pushed tag layout " + digest[:8])
+    return tag_layout
+
+
+def get_tag_layout(config_store: ConfigStore) -> Any:
+    """The active field layout: the one pushed over NT while it is published, else the file."""
+    if type(config_store.remote_config.tag_layout) == dict:
+        return config_store.remote_config.tag_layout
+    return load_tag_layout(config_store.remote_config.tag_layout_name)
+
+
+def get_tag_ids(tag_layout: Any) -> List[int]:
+    return sorted([tag_data["ID"] for tag_data in tag_layout["tags"]])
+
+
+class TagLayoutIndex:
+    """Field poses and OpenCV frame corner points of every tag in a layout, for one tag size.
+
+    Corners are stored in one contiguous array, so the object points for a set of observed tags are
+    a single gather. Both are converted from the layout in one batch when the index is built.
+    """
+
+    def __init__(self, tag_layout: Any, fid_size: float) -> None:
+        self.tag_layout = tag_layout
+        self.fid_size = fid_size
+        self._rows: Dict[int, int] = {tag_data["ID"]: row for row, tag_data in enumerate(tag_layout["tags"])}
+        quaternions = numpy.array([[tag_data["pose"]["rotation"]["quaternion"][x] for x in "WXYZ"] for tag_data in tag_layout["tags"]],
+                                  dtype=numpy.float64).reshape(-1, 4)
+        translations = numpy.array([[tag_data["pose"]["translation"][x] for x in "xyz"] for tag_data in tag_layout["tags"]],
+                                   dtype=numpy.float64).reshape(-1, 3)
+        transforms = se3.make_transforms(se3.quaternion_to_matrix(quaternions), translations)
+        self.tag_poses: Dict[int, Pose3d] = {tag_data["ID"]: pose for tag_data, pose in zip(tag_layout["tags"], se3.to_pose3ds(transforms))}
+
+        # Corners in the tag frame (WPILib axes, facing out of the tag along +x), in detection order
+        tag_corners = numpy.array([[0, fid_size / 2.0, -fid_size / 2.0],
+                                   [0, -fid_size / 2.0, -fid_size / 2.0],
+                                   [0, -fid_size / 2.0, fid_size / 2.0],
+                                   [0, fid_size / 2.0, fid_size / 2.0]])
+        self._corners = numpy.ascontiguousarray(
+            se3.transform_points(se3.WPILIB_TO_OPENCV, se3.transform_points(transforms, tag_corners)))
+
+    def matches(self, tag_layout: Any, fid_size: float) -> bool:
+        return self.tag_layout is tag_layout and self.fid_size == fid_size
+
+    def has_tag(self, tag_id: int) -> bool:
+        return tag_id in self._rows
+
+    def get_object_points(self, tag_ids: List[int]) -> numpy.typing.NDArray[numpy.float64]:
+        """Corner points of the given tags in field coordinates (OpenCV axes), four rows per tag."""
+        return self._corners[[self._rows[tag_id] for tag_id in tag_ids]].reshape(-1, 3)
+
+
+def get_tag_layout_index(tag_layout: Any, fid_size: float) -> "TagLayoutIndex":
+    """Index of a layout, built once and shared by every estimator until the layout or tag size changes."""
+    global _index_cache
+    with _layout_cache_lock:
+        if _index_cache == None or not _index_cache.matches(tag_layout, fid_size):
+            _index_cache = TagLayoutIndex(tag_layout, fid_size)
+        return _index_cache
@@ -0,0 +1,34 @@
+from typing import List
+
+import cv2
+import numpy
+import numpy.typing
+
+from config.config import ConfigStore
+from vision_types import FiducialImageObservation
+
+# Solvers are passed these coefficients for undistorted corners. OpenCV skips the distortion model
+# entirely for empty coefficients, where zeros would still be applied.
+ZERO_DISTORTION = numpy.zeros(0)
+
+
+def get_distortion_coefficients(image_observations: List[FiducialImageObservation], config_store: ConfigStore) -> numpy.typing.NDArray[numpy.float64]:
+    """Distortion coefficients to solve the observations with, which are all undistorted or not."""
+    if len(image_observations) > 0 and image_observations[0].undistorted:
+        return ZERO_DISTORTION
+    return config_store.local_config.distortion_coefficients
+
+
+def undistort_observations(image_observations: List[FiducialImageObservation], config_store: ConfigStore) -> List[FiducialImageObservation]:
+    """Undistort the corners of every observation in a frame with a single undistortPoints call.
+
+    Corners are mapped back through the calibrated camera matrix, so solvers keep the same camera
+    matrix with zero distortion and reprojection errors stay in pixels.
+    """
+    camera_matrix = config_store.local_config.camera_matrix
+    if len(image_observations) == 0 or camera_matrix.size == 0:
+        return image_observations
+    corners = numpy.concatenate([x.corners.reshape(-1, 1, 2) for x in image_observations])
+    undistorted_corners = cv2.undistortPoints(corners, camera_matrix, config_store.local_config.distortion_coefficients,
+                                              P=camera_matrix).reshape(len(image_observations), 1, 4, 2)
+    return [FiducialImageObservation(observation.tag_id, corners, True) for observation, corners in zip(image_observations, undistorted_corners)]
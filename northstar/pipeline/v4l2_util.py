@@ -0,0 +1,20 @@
+import fcntl
+import os
+import struct
+from typing import List, Tuple
+
+# From linux/videodev2.h and linux/v4l2-controls.h
+VIDIOC_S_CTRL = 0xC008561C  # _IOWR('V', 28, struct v4l2_control)
+V4L2_CID_GAIN = 0x00980913
+V4L2_CID_EXPOSURE_AUTO = 0x009A0901
+V4L2_CID_EXPOSURE_ABSOLUTE = 0x009A0902
+
+
+def set_controls(camera_id: int, controls: List[Tuple[int, int]]) -> None:
+    """Set V4L2 controls on an open camera, in order. Raises OSError if the driver rejects one."""
+    fd = os.open("/dev/video" + str(camera_id), os.O_RDWR | os.O_NONBLOCK)
+    try:
+        for control_id, value in controls:
+            fcntl.ioctl(fd, VIDIOC_S_CTRL, struct.pack("Ii", control_id, value))
+    finally:
+        os.close(fd)
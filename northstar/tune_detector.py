@@ -0,0 +1,114 @@
+import argparse
+import itertools
+import time
+
+import cv2
+import numpy
+
+from pipeline.detector_params import DETECTOR_PARAMS_FILENAME, make_detector_params, save_detector_params
+from pipeline.recorded_frames import load_recorded_frames
+
+# Parameter values to sweep. Every combination is evaluated, so keep the lists short.
+THRESHOLD_WINDOWS = [(3, 23, 10), (3, 13, 10), (5, 25, 20), (7, 7, 10)]  # (min, max, step)
+MIN_PERIMETER_RATES = [0.01, 0.03, 0.05]
+MAX_PERIMETER_RATES = [4.0, 2.0]
+POLYGONAL_APPROX_ACCURACY_RATES = [0.03, 0.05]
+CORNER_REFINEMENT_METHODS = [cv2.aruco.CORNER_REFINE_NONE, cv2.aruco.CORNER_REFINE_SUBPIX, cv2.aruco.CORNER_REFINE_CONTOUR]
+
+# Slow, exhaustive settings used to build the reference detections that recall and corner error
+# are measured against. The reference refines corners with a method that is not swept, otherwise
+# candidates using the same method would score zero corner error by construction.
+REFERENCE_PARAMS = {
+    "adaptiveThreshWinSizeMin": 3,
+    "adaptiveThreshWinSizeMax": 53,
+    "adaptiveThreshWinSizeStep": 4,
+    "minMarkerPerimeterRate": 0.01,
+    "cornerRefinementMethod": cv2.aruco.CORNER_REFINE_APRILTAG,
+}
+
+# Offline tuning of the ArUco detector parameters. Each parameter set is scored on detection time,
+# recall and mean corner error over a directory of recorded frames, and the chosen point of the
+# Pareto front is written to detector_params.json, which ArucoFiducialDetector loads at startup.
+
+
+def detect(images, aruco_dict, params):
+    detection_times = []
+    detections = []
+    for image in images:
+        start_time = time.perf_counter()
+        corners, ids, _ = cv2.aruco.detectMarkers(image, aruco_dict, parameters=params)
+        detection_times.append(time.perf_counter() - start_time)
+        detections.append({} if ids is None else {int(tag_id[0]): tag_corners[0] for tag_id, tag_corners in zip(ids, corners)})
+    return float(numpy.median(detection_times)), detections
+
+
+def score(detections, reference_detections):
+    reference_count = 0
+    found_count = 0
+    errors = []
+    for frame_detections, frame_reference in zip(detections, reference_detections):
+        for tag_id, reference_corners in frame_reference.items():
+            reference_count += 1
+            if tag_id in frame_detections:
+                found_count += 1
+                errors.append(float(numpy.linalg.norm(frame_detections[tag_id] - reference_corners, axis=1).mean()))
+    recall = found_count / reference_count if reference_count > 0 else 0.0
+    return recall, float(numpy.mean(errors)) if len(errors) > 0 else float("inf")
+
+
+def dominates(result_a, result_b) -> bool:
+    """Whether result a is at least as fast, complete and accurate as b, and better in one respect."""
+    at_least_as_good = result_a["time"] <= result_b["time"] and result_a["recall"] >= result_b["recall"] and \
+        result_a["error"] <= result_b["error"]
+    better = result_a["time"] < result_b["time"] or result_a["recall"] > result_b["recall"] or \
+        result_a["error"] < result_b["error"]
+    return at_least_as_good and better
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tune ArUco detector parameters on recorded frames")
+    parser.add_argument("frames", help="Directory of recorded frames")
+    parser.add_argument("--min-recall", type=float, default=0.99, help="Minimum recall of the chosen parameter set")
+    parser.add_argument("--max-error", type=float, default=1.0, help="Maximum mean corner error of the chosen parameter set (px)")
+    parser.add_argument("--output", default=DETECTOR_PARAMS_FILENAME)
+    args = parser.parse_args()
+
+    images = load_recorded_frames(args.frames)
+    aruco_dict = cv2.aruco.Dictionary_get(cv2.aruco.DICT_APRILTAG_36h11)
+
+    _, reference_detections = detect(images, aruco_dict, make_detector_params(REFERENCE_PARAMS))
+    print("Reference:", sum([len(x) for x in reference_detections]), "tags in", len(images), "frames")
+
+    results = []
+    for window, min_perimeter_rate, max_perimeter_rate, approx_accuracy_rate, refinement_method in itertools.product(
+            THRESHOLD_WINDOWS, MIN_PERIMETER_RATES, MAX_PERIMETER_RATES, POLYGONAL_APPROX_ACCURACY_RATES, CORNER_REFINEMENT_METHODS):
+        values = {
+            "adaptiveThreshWinSizeMin": window[0],
+            "adaptiveThreshWinSizeMax": window[1],
+            "adaptiveThreshWinSizeStep": window[2],
+            "minMarkerPerimeterRate": min_perimeter_rate,
+            "maxMarkerPerimeterRate": max_perimeter_rate,
+            "polygonalApproxAccuracyRate": approx_accuracy_rate,
+            "cornerRefinementMethod": refinement_method,
+        }
+        detection_time, detections = detect(images, aruco_dict, make_detector_params(values))
+        recall, error = score(detections, reference_detections)
+        results.append({"values": values, "time": detection_time, "recall": recall, "error": error})
+
+    pareto_front = [x for x in results if not any([dominates(y, x) for y in results])]
+    pareto_front.sort(key=lambda x: x["time"])
+    print("Pareto front:")
+    for result in pareto_front:
+        print("  " + str(round(result["time"] * 1000, 2)) + " ms, recall " + str(round(result["recall"], 3)) +
+              ", corner error " + str(round(result["error"], 3)) + " px:", result["values"])
+
+    # Fastest set that meets the recall and accuracy targets, otherwise the most complete and accurate
+    acceptable = [x for x in pareto_front if x["recall"] >= args.min_recall and x["error"] <= args.max_error]
+    if len(acceptable) > 0:
+        best = acceptable[0]
+    else:
+        print("No parameter set meets the targets, choosing the highest recall")
+        best = max(pareto_front, key=lambda x: (x["recall"], -x["error"]))
+    save_detector_params(best["values"], args.output)
+    print("Wrote", args.output + ":", round(best["time"] * 1000, 2), "ms, recall", round(best["recall"], 3),
+          "corner error", round(best["error"], 3), "px")
@@ -1,5 +1,5 @@
-from dataclasses import dataclass
-from typing import List, Union
+from dataclasses import dataclass, field
+from typing import List, Tuple, Union
 
 import numpy
 import numpy.typing
@@ -10,6 +10,7 @@ from wpimath.geometry import *
 class FiducialImageObservation:
     tag_id: int
     corners: numpy.typing.NDArray[numpy.float64]
+    undistorted: bool = False  # Solve with zero distortion, see pipeline/undistortion.py
 
 
 @dataclass(frozen=True)
@@ -21,6 +22,12 @@ class FiducialPoseObservation:
     error_1: float
 
 
+# Reasons a visible tag was left out of the camera pose solve on the cheap path
+TAG_SKIPPED_SMALL = 1
+TAG_SKIPPED_OBLIQUE = 2
+TAG_SKIPPED_CAPPED = 3
+
+
 @dataclass(frozen=True)
 class CameraPoseObservation:
     tag_ids: List[int]
@@ -28,3 +35,5 @@ class CameraPoseObservation:
     error_0: float
     pose_1: Union[Pose3d, None]
     error_1: Union[float, None]
+    cheap_path: bool = False
+    skipped_tags: List[Tuple[int, int]] = field(default_factory=list)  # (tag ID, TAG_SKIPPED_* reason)